@@ -1,7 +1,17 @@
-from typing import Generator
+from itertools import islice
+from typing import Generator, Iterable
 
 
-def batch_generator(items: list, batch_size: int) -> Generator[list, None, None]:
-    """生成文件批次"""
-    for i in range(0, len(items), batch_size):
-        yield items[i: i + batch_size]
+def batch_generator(items: Iterable, batch_size: int) -> Generator[list, None, None]:
+    """生成文件批次
+
+    items 可以是任意可迭代对象 (如生成器)；numpy 数组与 memoryview 按切片返回视图，不复制。
+    """
+    if isinstance(items, memoryview) or hasattr(items, "shape"):
+        for i in range(0, len(items), batch_size):
+            yield items[i : i + batch_size]
+        return
+
+    it = iter(items)
+    while batch := list(islice(it, batch_size)):
+        yield batch
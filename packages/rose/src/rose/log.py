@@ -1,17 +1,26 @@
+import atexit
 import logging
+from functools import cache
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from multiprocessing.util import Finalize
 from pathlib import Path
 
-from concurrent_log_handler import ConcurrentRotatingFileHandler
 from icecream import ic
 
 
-def get_logger(name: str, file=None, level=logging.INFO) -> logging.Logger:
+@cache
+def get_logger(
+    name: str, file=None, level=logging.INFO, multiprocess: bool = False
+) -> logging.Logger:
     """获取或创建指定名称的logger，确保仅配置一次。
 
+    结果按参数缓存，进程内重复调用 (如每个任务/文件) 直接返回同一 logger。
+
     Args:
         name: 模块唯一标识 (如 'log_name')
         log_file: 日志文件路径 (None表示不写文件)
         level: 日志级别
+        multiprocess: 多进程写同一文件时使用带文件锁的 ConcurrentRotatingFileHandler
 
     Returns:
         logging.Logger: 日志记录器
@@ -26,17 +35,30 @@ def get_logger(name: str, file=None, level=logging.INFO) -> logging.Logger:
         if file:
             file_dir = Path("logs")
             file_dir.mkdir(parents=True, exist_ok=True)
-            file_handler = ConcurrentRotatingFileHandler(
+            if multiprocess:
+                from concurrent_log_handler import ConcurrentRotatingFileHandler
+
+                handler_class = ConcurrentRotatingFileHandler
+            else:
+                handler_class = RotatingFileHandler
+            file_handler = handler_class(
                 file_dir / file, mode="a", maxBytes=1024 * 1024 * 1, backupCount=5
             )
             file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+            # 缓冲写入，ERROR 及以上立即刷新
+            memory_handler = MemoryHandler(
+                capacity=1024, flushLevel=logging.ERROR, target=file_handler
+            )
+            atexit.register(memory_handler.flush)
+            # 子进程退出时不执行 atexit
+            Finalize(memory_handler, memory_handler.flush, exitpriority=10)
+            logger.addHandler(memory_handler)
 
     return logger
 
 
 def write_errors(errs, errs_txt="errors.txt"):
+    buf = "".join(err if err.endswith("\n") else err + "\n" for err in errs)
     with open(errs_txt, "w") as f:
-        for err in errs:
-            f.write(err)
+        f.write(buf)
     ic(f"Check {errs_txt} for more information")
@@ -1,6 +1,12 @@
+import os
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from glob import iglob
 from pathlib import Path
+from typing import Iterator
 
 
+@lru_cache(maxsize=None)
 def binuse(command, bin_path: str = "bin") -> Path:
     """get bin command
 
@@ -18,18 +24,63 @@ def binuse(command, bin_path: str = "bin") -> Path:
         raise FileNotFoundError(f"{command=} not found in {bin_path}.")
 
 
+def scandir_recursive(path) -> Iterator[os.DirEntry]:
+    """Yield entries under a path recursively, reusing cached `DirEntry` info.
+
+    Symlinked directories are not followed, unreadable directories are skipped.
+    """
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                yield entry
+                if entry.is_dir(follow_symlinks=False):
+                    yield from scandir_recursive(entry.path)
+    except PermissionError:
+        return
+
+
+def scan_files(root, pattern: str = "*") -> Iterator[str]:
+    """Yield paths of files under root whose name matches pattern, like `rglob`.
+
+    Walks with an explicit stack of `os.scandir` calls and never builds `Path`
+    objects; a plain suffix pattern such as "*.SAC" is matched with `endswith`.
+    """
+    suffix = pattern[1:]
+    if not pattern.startswith("*") or any(c in suffix for c in "*?["):
+        suffix = None
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif (
+                        entry.name.endswith(suffix)
+                        if suffix is not None
+                        else fnmatchcase(entry.name, pattern)
+                    ):
+                        yield entry.path
+        except PermissionError:
+            continue
+
+
 def find_last_subdirs(path: Path) -> list[Path]:
     """Find the last subdirectory in a path."""
     if not path.is_dir():
         return []
 
-    subdirs = [child for child in path.iterdir() if child.is_dir()]
-    if not subdirs:
-        return [path]
-
     last_subdirs = []
-    for subdir in subdirs:
-        last_subdirs.extend(find_last_subdirs(subdir))
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            subdirs = [Path(entry.path) for entry in it if entry.is_dir()]
+        if subdirs:
+            # reversed to keep the depth-first order of the recursive version
+            stack.extend(reversed(subdirs))
+        else:
+            last_subdirs.append(current)
 
     return last_subdirs
 
@@ -38,20 +89,28 @@ def glob(dir, method, patterns, exclude_parts=None, include_parts=None) -> list[
     """Glob files in a directory with given patterns and exclude patterns."""
     targets = []
     dir = Path(dir)
-    if method == "glob":
+    if method in ("glob", "rglob"):
+        recursive = method == "rglob"
         for pattern in patterns:
-            targets += list(dir.glob(pattern))
-    elif method == "rglob":
-        for pattern in patterns:
-            targets += list(dir.rglob(pattern))
-
-    # filter out files
-    if exclude_parts:
-        for part in exclude_parts:
-            targets = [target for target in targets if part not in target.parts]
-    if include_parts:
-        for part in include_parts:
-            targets = [target for target in targets if part in target.parts]
+            if recursive:
+                pattern = os.path.join("**", pattern)
+            targets += [
+                dir / target
+                for target in iglob(
+                    pattern, root_dir=dir, recursive=recursive, include_hidden=True
+                )
+            ]
+
+    # filter out files in one pass: no excluded part and all included parts
+    exclude = frozenset(exclude_parts or ())
+    include = frozenset(include_parts or ())
+    if exclude or include:
+        parts_index = ((target, frozenset(target.parts)) for target in targets)
+        targets = [
+            target
+            for target, parts in parts_index
+            if exclude.isdisjoint(parts) and include <= parts
+        ]
 
     return targets
 
@@ -62,10 +121,8 @@ def copy_structure(src, dest):
     dest_path = Path(dest)
 
     dest_path.mkdir(parents=True, exist_ok=True)
-    for item in src_path.glob("**/*"):
-        if item.is_dir():
-            target_dir = path_relative(src_path, item, dest_path)
-            target_dir.mkdir(parents=True, exist_ok=True)
+    for dirpath, _, _ in os.walk(src_path):
+        os.makedirs(dest_path / os.path.relpath(dirpath, src_path), exist_ok=True)
 
 
 def path_relative(src, target: Path, dest: Path | None = None):
@@ -1,34 +1,58 @@
 import logging
+import os
+import queue
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from pathlib import Path
 
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn.header import FDSNNoDataException
+from rose import batch_generator, pather
 from tqdm import tqdm
 
 LOG_FILE = "download.log"
 NET = "net"
-client = Client("IRIS", user="<email>", password="<token>")
+client = None
 
 
-def download(sta_list, start, end):
+def _init_client():
+    """Create the shared FDSN client once, all download threads reuse it."""
+    global client
+    if client is None:
+        client = Client("IRIS", user="<email>", password="<token>")
+
+
+def download(sta_list, start, end, max_workers=16, bulk_days=30):
     dates = list(date_generator(start, end))
     tasks_num = len(sta_list) * len(dates)
     logging.info(f"Download start, total {tasks_num} tasks.")
     postfix = {"success": 0, "failed": 0, "skipped": 0, "nodata": 0}
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = {
-            executor.submit(download_worker, sta, date)
-            for sta in sta_list
-            for date in dates
-        }
-        with tqdm(total=tasks_num, desc="Downloading: ") as pbar:
+    # one scan of the archive instead of a stat per station-day
+    completed = _completed_days()
+    _init_client()
+    with tqdm(total=tasks_num, desc="Downloading: ") as pbar:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = set()
+            for sta in sta_list:
+                missing = [
+                    date
+                    for date in dates
+                    if (sta, date.year, date.julday) not in completed
+                ]
+                postfix["skipped"] += len(dates) - len(missing)
+                pbar.update(len(dates) - len(missing))
+                futures.update(
+                    executor.submit(download_worker, sta, batch)
+                    for batch in batch_generator(missing, bulk_days)
+                )
             for future in as_completed(futures):
                 result = future.result()
-                postfix[result] += 1
-                pbar.update(1)
+                for key, num in result.items():
+                    postfix[key] += num
+                pbar.update(sum(result.values()))
                 pbar.set_postfix(postfix)
     summary = (
         "Download complete.\n"
@@ -40,33 +64,83 @@ def download(sta_list, start, end):
     print(f'Check "{LOG_FILE}" for details.')
 
 
-def download_worker(sta, date):
-    year = str(date.year)
-    julday = f"{date.julday:03d}"
-    dest_dir = Path(NET) / sta / year / julday
-    if dest_dir.exists() and len(list(dest_dir.iterdir())) == 3:
-        return "skipped"
+def _completed_days():
+    """(sta, year, julday) of day directories already holding 3 files"""
+    counts = Counter(
+        os.path.dirname(entry.path)
+        for entry in pather.scandir_recursive(NET)
+        if not entry.is_dir(follow_symlinks=False)
+    )
+    completed = set()
+    for day_dir, num in counts.items():
+        parts = Path(day_dir).relative_to(NET).parts
+        if num == 3 and len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+            sta, year, julday = parts
+            completed.add((sta, int(year), int(julday)))
+    return completed
+
+
+def download_worker(sta, dates):
+    """Download missing days of a station with one bulk request."""
+    result = {"success": 0, "failed": 0, "nodata": 0}
+    missing = {(date.year, date.julday) for date in dates}
+    bulk = [(NET, sta, "*", "*", date, date + 86400) for date in dates]
     try:
-        st = client.get_waveforms(
-            network=NET,
-            station=sta,
-            starttime=date,
-            endtime=date + 86400,
-            location="*",
-            channel="*",
-        )
-        dest_dir.mkdir(parents=True, exist_ok=True)
-        for tr in st:
-            cha = tr.stats.channel
-            fname = f"{NET}.{sta}.{year}.{julday}.{cha}.sac"
-            tr.write(str(dest_dir / fname), format="SAC")
-        return "success"
+        st = client.get_waveforms_bulk(bulk)
     except FDSNNoDataException:
-        logging.warning(f"No Data for {sta} in {date}.")
-        return "nodata"
+        logging.warning(f"No Data for {sta} from {bulk[0][4]} to {bulk[-1][5]}.")
+        result["nodata"] += len(missing)
+        return result
     except Exception as e:
-        logging.error(f"error date: {date} {e}.")
-        return "failed"
+        logging.error(f"error station: {sta} {e}.")
+        result["failed"] += len(missing)
+        return result
+
+    # cut each requested day out of the bulk stream, contiguous records
+    # come back merged into traces spanning several days
+    written = set()
+    for date in dates:
+        key = (date.year, date.julday)
+        for tr in st.slice(date, date + 86400, nearest_sample=False):
+            if not tr.stats.npts or tr.stats.starttime >= date + 86400:
+                continue
+            dest_dir = _day_dir(sta, *key)
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            fname = f"{NET}.{sta}.{key[0]}.{key[1]:03d}.{tr.stats.channel}.sac"
+            try:
+                tr.write(str(dest_dir / fname), format="SAC")
+                written.add(key)
+            except Exception as e:
+                logging.error(f"error writing: {dest_dir / fname} {e}.")
+    for key in missing:
+        if key not in written:
+            logging.warning(f"No Data for {sta} in {key[0]}.{key[1]:03d}.")
+    result["success"] += len(written)
+    result["nodata"] += len(missing) - len(written)
+    return result
+
+
+def _day_dir(sta, year, julday):
+    return Path(NET) / sta / str(year) / f"{julday:03d}"
+
+
+def setup_logging(level=logging.ERROR):
+    """Log through a queue so download threads never block on the file.
+
+    A single listener thread drains the queue into a buffered file handler,
+    errors are written at once. Returns the listener and the buffered
+    handler, stop the listener then close the handler to flush the rest.
+    """
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    buffered = MemoryHandler(1024, flushLevel=logging.ERROR, target=file_handler)
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=level, handlers=[QueueHandler(log_queue)])
+    listener = QueueListener(log_queue, buffered)
+    listener.start()
+    return listener, buffered
 
 
 def date_generator(start, end):
@@ -79,22 +153,28 @@ def date_generator(start, end):
 def remove_by_size(limit: int):
     size_limit = limit * 1024 * 1024
     size_max = 34_560_636
-    for ifile in Path(NET).rglob("*.sac"):
-        file_size = ifile.stat().st_size
-        if file_size < size_limit:
-            ifile.unlink()
+
+    def _maybe_unlink(entry):
+        if entry.stat().st_size < size_limit:
+            os.unlink(entry.path)
+
+    sacs = [
+        entry
+        for entry in pather.scandir_recursive(NET)
+        if entry.is_file(follow_symlinks=False) and entry.name.endswith(".sac")
+    ]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(_maybe_unlink, sacs))
 
 
 if __name__ == "__main__":
     sta_list = [i.name for i in Path(NET).glob("*")]
-    logging.basicConfig(
-        level=logging.ERROR,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[logging.FileHandler(LOG_FILE)],
-    )
+    listener, buffered = setup_logging()
     num = 10
     while num > 0:
         remove_by_size(10)
         download(sta_list, UTCDateTime(2023, 1, 1), UTCDateTime(2025, 1, 1))
         time.sleep(1)
         num -= 1
+    listener.stop()
+    buffered.close()
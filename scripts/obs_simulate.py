@@ -1,33 +1,58 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 
+import numpy as np
 import obspy
+import scipy.fft
+from obspy.signal import invsim
+from scipy.signal.windows import hann
 from tqdm import tqdm
 
 src_dir = Path("/path/to/nz_obs/")
 dest_dir = Path("/path/to/nz_obs_deconv")
 
+_paz_to_freq_resp = invsim.paz_to_freq_resp
 
-def process_per_channel(pattern, paz):
-    total = 0
-    for sac in src_dir.rglob(pattern):
-        # st = _st_deconv(sac, inv)
-        st = _st_simulated(sac, paz)
-        target = dest_dir / sac.relative_to(src_dir)
-        target.parent.mkdir(parents=True, exist_ok=True)
-        target = target.with_suffix(".deconv.sac")
-        st.write(str(target), format="SAC")
-        total += 1
-    return total
+
+@lru_cache(maxsize=16)
+def _cached_freq_resp(poles, zeros, scale_fac, t_samp, nfft):
+    return _paz_to_freq_resp(list(poles), list(zeros), scale_fac, t_samp, nfft, True)
+
+
+def _paz_to_freq_resp_cached(poles, zeros, scale_fac, t_samp, nfft, freq=False):
+    """`paz_to_freq_resp` evaluated once per (paz, delta, nfft).
+
+    Day-long traces share the same length, so `Trace.simulate` keeps asking
+    for the same response. A copy is returned because `simulate_seismometer`
+    inverts the response in place.
+    """
+    h, f = _cached_freq_resp(tuple(poles), tuple(zeros), scale_fac, t_samp, nfft)
+    if freq:
+        return h.copy(), f
+    return h.copy()
+
+
+invsim.paz_to_freq_resp = _paz_to_freq_resp_cached
+
+
+def simulate_one(task):
+    sac, paz = task
+    # st = _st_deconv(sac, inv)
+    st = _st_simulated(sac, paz)
+    target = dest_dir / sac.relative_to(src_dir)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target = target.with_suffix(".deconv.sac")
+    st.write(str(target), format="SAC")
+    return 1
 
 
 def _st_simulated(sac, paz):
     st = obspy.read(sac)
     st.merge(method=1, fill_value="interpolate")
     for tr in st:
-        tr.detrend("demean")
-        tr.detrend("linear")
-        tr.taper(max_percentage=0.05, type="hann")
+        tr.data = _rmt(tr.data)
         tr.simulate(paz_remove=paz, pre_filt=[0.003, 0.006, 1, 2])
         # tr.data *= 1e9
     return st
@@ -37,9 +62,7 @@ def _st_deconv(sac, inv):
     st = obspy.read(sac)
     st.merge(method=1, fill_value="interpolate")
     for tr in st:
-        tr.detrend("demean")
-        tr.detrend("linear")
-        tr.taper(max_percentage=0.05, type="hann")
+        tr.data = _rmt(tr.data)
         tr.remove_response(
             inventory=inv,
             water_level=None,
@@ -52,6 +75,35 @@ def _st_deconv(sac, inv):
     return st
 
 
+def _rmt(data, max_percentage=0.05):
+    """`rmean; rtr; taper` in one pass over the data.
+
+    A least squares line fit also removes the mean, so `demean` + `linear`
+    reduce to subtracting one fitted line before the hann taper.
+    """
+    data = np.require(data, dtype=np.float64)
+    xc, taper = _rmt_kernel(len(data), max_percentage)
+    slope = np.dot(xc, data) / np.dot(xc, xc) if len(data) > 1 else 0.0
+    data = data - data.mean()
+    data -= slope * xc
+    data *= taper
+    return data
+
+
+@lru_cache(maxsize=32)
+def _rmt_kernel(npts, max_percentage):
+    """centered sample index and hann taper (same as `Trace.taper`) per length"""
+    xc = np.arange(npts, dtype=np.float64) - (npts - 1) / 2
+    wlen = min(int(max_percentage * npts), npts // 2)
+    sides = hann(2 * wlen) if 2 * wlen == npts else hann(2 * wlen + 1)
+    taper = np.hstack(
+        (sides[:wlen], np.ones(npts - 2 * wlen), sides[len(sides) - wlen :])
+    )
+    xc.flags.writeable = False
+    taper.flags.writeable = False
+    return xc, taper
+
+
 def _pp_gen():
     # displacement
     paz_seis = {
@@ -94,17 +146,31 @@ def _pp_gen():
         yield pattern, paz
 
 
-def deconv():
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = {
-            executor.submit(process_per_channel, pattern, paz)
-            for pattern, paz in _pp_gen()
-        }
-        with tqdm(desc="Deconvolutioning ...") as pbar:
-            total = 0
-            for future in as_completed(futures):
-                batch_total = future.result()
-                total += batch_total
+def _init_fft(workers):
+    """Route ObsPy's `np.fft` calls to threaded `scipy.fft` in each worker."""
+    if workers > 1:
+        np.fft.rfft = partial(scipy.fft.rfft, workers=workers)
+        np.fft.irfft = partial(scipy.fft.irfft, workers=workers)
+
+
+def deconv(max_workers=None, chunksize=32):
+    # one task per file keeps all cores busy (None: one worker per CPU)
+    tasks = [
+        (sac, paz) for pattern, paz in _pp_gen() for sac in src_dir.rglob(pattern)
+    ]
+    # spare cores go to FFT threads instead of oversubscribing the processes
+    cpus = os.cpu_count() or 1
+    fft_workers = max(1, cpus // (max_workers or cpus))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_fft, initargs=(fft_workers,)
+    ) as executor:
+        total = 0
+        for done in tqdm(
+            executor.map(simulate_one, tasks, chunksize=chunksize),
+            total=len(tasks),
+            desc="Deconvolutioning ...",
+        ):
+            total += done
         print(f"All {total} sac files deconvolutioned.")
 
 
@@ -1,3 +1,5 @@
+from icecream import ic
+
 from halo.merge import check_merge_prior, check_merge_result
 from halo.response import (
     check_deconv_prior,
@@ -7,6 +9,10 @@ from halo.response import (
 )
 from halo.sample import check_resample
 
+# frame introspection of `ic` is skipped when running with `python -O`
+if not __debug__:
+    ic.disable()
+
 
 def hello() -> str:
     return "Halo seispy."
@@ -19,13 +19,15 @@ def check_merge_prior(sacs_dir, specials):
 
 
 def show_isac_and_merged_sac(sacs: list[Path]):
-    st_combined = obspy.Stream()
+    traces = []
 
     for sac in sacs:
         ic(sac.name)
         st = obspy.read(sac)
         st.plot()
-        st_combined += st
+        traces.extend(st.traces)
+
+    st_combined = obspy.Stream(traces=traces)
 
     # st_combined
     st_combined.sort()
@@ -38,9 +40,10 @@ def show_isac_and_merged_sac(sacs: list[Path]):
 
 def check_merge_result(src_dir, dest_file):
     src_path = Path(src_dir)
-    src_st = obspy.Stream()
+    traces = []
     for zsac in src_path.glob("*BHZ*.SAC"):
-        src_st += obspy.read(zsac)
+        traces.extend(obspy.read(zsac).traces)
+    src_st = obspy.Stream(traces=traces)
     src_st.plot()
     dest_st = obspy.read(dest_file)
     dest_st.plot()
@@ -1,13 +1,31 @@
-# from seispy.download import IRISDownloader
-from seispy import collate, correct, event, mcmc, response
-from seispy.download import download_events_usgs
-from seispy.resample import resample_by_station, resample_to
+import importlib
+
+# submodules and functions are imported on first access (PEP 562), so worker
+# processes only pay for the obspy/pandas imports they actually use.
+_SUBMODULES = {"collate", "correct", "event", "mcmc", "response"}
+_FUNCTIONS = {
+    "download_events_usgs": "seispy.download",
+    "resample_by_station": "seispy.resample",
+    "resample_to": "seispy.resample",
+}
 
 
 def hello() -> str:
     return "Hello from SeisPy!"
 
 
+def __getattr__(name: str):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"seispy.{name}")
+    if name in _FUNCTIONS:
+        return getattr(importlib.import_module(_FUNCTIONS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
 __all__ = [
     "hello",
     "response",
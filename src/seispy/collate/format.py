@@ -1,10 +1,12 @@
 import logging
+import multiprocessing
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
+from itertools import repeat
 from pathlib import Path
 
-import obspy
 import pandas as pd
+from obspy.io.sac import SACTrace
 from rose import get_logger
 from tqdm import tqdm
 
@@ -12,7 +14,16 @@ _LOG_FORMAT = {
     "file": "format.log",
     "name": "format",
     "level": logging.INFO,
+    "multiprocess": True,
 }
+# header columns shipped to workers, optional ones default to -12345
+_STATION_COLUMNS = {
+    "latitude": None,
+    "longitude": None,
+    "elevation": -12345,
+    "depth": -12345,
+}
+_EVENT_COLUMNS = {**_STATION_COLUMNS, "mag": None}
 
 
 def format_per_event(event_data, src_path, dest_path, pattern, stations_dict):
@@ -58,31 +69,20 @@ def format_per_event(event_data, src_path, dest_path, pattern, stations_dict):
                 logger.error(f"No station info for {sac_file.name}")
                 continue
 
-            # update header info
-            tr = obspy.read(str(sac_file))[0]
-            # change stats
-            stats = tr.stats
-            stats.station = station
-            stats.channel = channel
-            if not stats.location:
-                stats.location = "10"  # khole
-            # update sac
-            sac = stats.sac
+            dest_file = dest_event_dir / f"{event_dir}.{station}.{channel}.sac"
+            # update header info, SACTrace skips the Trace/Stats conversion
+            sac = SACTrace.read(sac_file)
+            sac.kstnm = station
+            sac.kcmpnm = channel
+            if not sac.khole:
+                sac.khole = "10"
             # station info
-            sac.stla = station_info["latitude"]
-            sac.stlo = station_info["longitude"]
-            sac.stel = station_info.get("elevation", -12345)
-            sac.stdp = station_info.get("depth", -12345)
+            sac.stla, sac.stlo, sac.stel, sac.stdp = station_info
             # event info
-            sac.evla = event_info["latitude"]
-            sac.evlo = event_info["longitude"]
-            sac.evel = event_info.get("elevation", -12345)
-            sac.evdp = event_info.get("depth", -12345)
-            sac.mag = event_info["mag"]
-            sac.lcalda = 1  # 0=FALSE, 1=TRUE
+            sac.evla, sac.evlo, sac.evel, sac.evdp, sac.mag = event_info
+            sac.lcalda = True
 
-            dest_file = dest_event_dir / f"{event_dir}.{station}.{channel}.sac"
-            tr.write(str(dest_file), format="SAC")
+            sac.write(dest_file)
             post["success"] += 1
 
         except Exception as e:
@@ -111,11 +111,18 @@ def format_head(
     dest_path = Path(dest_dir)
 
     # 读取事件数据
-    events_df = pd.read_csv(events_csv)
+    # SAC header floats are 4 bytes, float32 loses nothing
+    events_df = pd.read_csv(
+        events_csv,
+        usecols=lambda col: col == "time" or col in _EVENT_COLUMNS,
+        dtype={col: "float32" for col in _EVENT_COLUMNS},
+    )
 
     n_before = len(events_df)
 
-    events_df["time"] = pd.to_datetime(events_df["time"], utc=True, errors="coerce")
+    events_df["time"] = pd.to_datetime(
+        events_df["time"], utc=True, errors="coerce", format="ISO8601"
+    )
     events_df = events_df.dropna(subset=["time"])
 
     if len(events_df) != n_before:
@@ -124,11 +131,15 @@ def format_head(
         )
 
     events_df["event_dir"] = events_df["time"].dt.strftime("%Y%m%d%H%M%S")
-    events_dict = events_df.set_index("event_dir").to_dict("index")
+    events_dict = _lookup_table(events_df, "event_dir", _EVENT_COLUMNS)
 
     # 读取台站数据
-    stations_df = pd.read_csv(stations_csv)
-    stations_dict = stations_df.set_index("station").to_dict("index")
+    stations_df = pd.read_csv(
+        stations_csv,
+        usecols=lambda col: col == "station" or col in _STATION_COLUMNS,
+        dtype={"station": str, **{col: "float32" for col in _STATION_COLUMNS}},
+    )
+    stations_dict = _lookup_table(stations_df, "station", _STATION_COLUMNS)
 
     # 准备事件任务列表
     event_tasks = []
@@ -163,20 +174,38 @@ def format_head(
 
     # 使用进程池处理
     post = {"success": 0, "failed": 0}
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver")
+    ) as executor:
         futures = {executor.submit(processor, task): task for task in event_tasks}
 
-        with tqdm(total=len(futures), desc="Formating events...") as pbar:
-            for future in as_completed(futures):
+        # refresh the bar once per chunk of finished events
+        chunk = 32
+        with tqdm(
+            total=len(futures), desc="Formating events...", smoothing=0
+        ) as pbar:
+            for done, future in enumerate(as_completed(futures), 1):
                 ipost = future.result()
                 post["success"] += ipost.get("success", 0)
                 post["failed"] += ipost.get("failed", 0)
-                pbar.set_postfix(post)
-                pbar.update()
+                if done % chunk == 0:
+                    pbar.set_postfix(post, refresh=False)
+                    pbar.update(chunk)
+            pbar.set_postfix(post, refresh=False)
+            pbar.update(len(futures) % chunk)
     logger.info(f"Format complete with {post}.")
     logger.info("=" * 60 + "\n")
 
 
+def _lookup_table(df, key, columns) -> dict[str, tuple]:
+    """key -> tuple of column values, only the columns written to the header"""
+    values = [
+        df[col] if col in df or default is None else repeat(default)
+        for col, default in columns.items()
+    ]
+    return dict(zip(df[key], zip(*values)))
+
+
 if __name__ == "__main__":
     format_head(
         src_dir="path/to/source",
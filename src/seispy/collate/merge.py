@@ -1,15 +1,25 @@
-import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import multiprocessing
+from functools import partial
 from pathlib import Path
 
 import obspy
-from icecream import ic
-from rose import pather, write_errors
+from obspy.io.sac import SACTrace
+from rose import get_logger, pather, write_errors
 from tqdm import tqdm
 
+_LOG_MERGE = {
+    "name": "merge",
+    "file": "merge.log",
+    "level": logging.INFO,
+}
+
 
 def merge_by_day(
-    src: str | Path, pattern: str = "*.SAC", remove_src: bool = True
+    src: str | Path,
+    pattern: str = "*.SAC",
+    remove_src: bool = True,
+    max_workers: int | None = None,
 ) -> None:
     """merge sac files by day
 
@@ -17,46 +27,47 @@ def merge_by_day(
         src: source directory.
         pattern: search pattern.
         remove_src: whether remove source files after mergeing.
+        max_workers: max worker processes, defaults to the number of CPUs.
     """
     src_path = Path(src)
     days = pather.find_last_subdirs(src_path)
     errs = []
-    with ProcessPoolExecutor(max_workers=5) as executor:
-        futures = {
-            executor.submit(_merge_targets, day, pattern, remove_src)
-            for day in days
-            if day.is_dir()
-        }
-        for future in tqdm(
-            as_completed(futures),
-            total=len(futures),
+    merge = partial(_merge_targets, pattern=pattern, remove_src=remove_src)
+    # forkserver: workers do not inherit locks held by the parent's threads
+    ctx = multiprocessing.get_context("forkserver")
+    with ctx.Pool(max_workers) as pool:
+        for err in tqdm(
+            pool.imap_unordered(merge, days, chunksize=8),
+            total=len(days),
             mininterval=2,
+            smoothing=0,
             desc="Merging at last subdirs",
         ):
-            future = future.result()
-            if future:
-                errs.append(future)
+            if err:
+                errs.append(err)
     if errs:
         write_errors(errs)
     else:
-        ic("All Done with NO errors!")
+        get_logger(**_LOG_MERGE).info(f"Merged {len(days)} days with NO errors.")
+        print("All Done with NO errors!")
 
 
 def _merge_targets(day: Path, pattern, remove_src: bool) -> str | None:
     sacs = list(day.glob(pattern))
     try:
-        st = obspy.Stream()
-        for sac in sacs:
-            st += obspy.read(sac)
+        # one glob read, skip format detection of every file
+        st = obspy.read(str(day / pattern), format="SAC", check_compression=False)
         st.sort()
         st.merge(method=1, fill_value="interpolate")
 
+        sac = sacs[-1]
         sac_parts = sac.stem.split(".")
         target_parts = sac_parts[:-1] + ["merged", "sac"]
         for tr in st:
             target_parts[3] = tr.stats.channel
             target_str = str(sac.parent / ".".join(target_parts))
-            tr.write(target_str, format="SAC")
+            # skip the plugin dispatch of `Trace.write`
+            SACTrace.from_obspy_trace(tr).write(target_str)
 
     except Exception as err:
         return f"Errors in {day}:\n  {err}"
@@ -64,4 +75,3 @@ def _merge_targets(day: Path, pattern, remove_src: bool) -> str | None:
     if remove_src:
         for sac in sacs:
             sac.unlink()
-    time.sleep(0.1)
@@ -1,24 +1,41 @@
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import re
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import lru_cache
 from pathlib import Path
 from typing import Union
 
+import numpy as np
 import obspy
-from rose import batch_generator, get_logger
+from obspy.io.sac import SACTrace
+from rose import batch_generator, get_logger, pather, write_errors
 from tqdm import tqdm
 
 _LOG_MSEED2SAC = {
     "name": "mseed2sac",
     "file": "mseed2sac.log",
     "level": logging.INFO,
+    "multiprocess": True,
 }
+# SDS file name: net.sta.loc.cha.type.year.day
+_SDS_NAME_RE = re.compile(
+    r"(?P<net>[^.]+)\.(?P<sta>[^.]+)\.[^.]*\.[^.]+\.[A-Z]\."
+    r"(?P<year>\d{4})\.(?P<day>\d{3})"
+)
 
 
 def mseed2sac_dir(
     src_dir: Union[Path, str],
     dest_dir: Union[Path, str],
     pattern: str = "*.miniseed",
-    batch_size: int = 1000,
+    batch_size: int | None = None,
     max_workers: int = 5,
 ) -> None:
     """MiniSEED 转 SAC 主函数
@@ -27,7 +44,7 @@ def mseed2sac_dir(
         src_dir: 源目录路径
         dest_dir: 目标目录路径
         pattern: 文件匹配模式
-        batch_size: 每批处理文件数
+        batch_size: 每批处理文件数, 默认约每进程 4 批 (不超过 1000)
         max_workers: 最大并行进程数
         log_file: 自定义日志文件路径（可选）
     """
@@ -39,51 +56,129 @@ def mseed2sac_dir(
     dest_base = Path(dest_dir)
     dest_base.mkdir(parents=True, exist_ok=True)
 
-    # 获取文件列表
-    file_paths = list(src_path.rglob(pattern))
+    # 获取文件列表, 同一天的文件排在一起, 各批次的目标目录基本互不重叠
+    file_paths = sorted(
+        map(Path, pather.scan_files(src_path, pattern)), key=_day_key
+    )
     total_files = len(file_paths)
     logger.info(f"Found {total_files} files")
+    # several batches per worker keep the pool balanced when files differ in size
+    if batch_size is None:
+        batch_size = max(1, min(1000, total_files // (max_workers * 4)))
 
     # 多进程处理
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(_process_batch, batch, dest_base)
-            for batch in batch_generator(file_paths, batch_size)
-        }
-
-        with tqdm(total=total_files, desc="Processing") as pbar:
-            success = 0
-            for future in as_completed(futures):
-                isuccess = future.result()
+    success = 0
+    errs = []
+    with (
+        ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        ) as executor,
+        # postfix is redrawn with the bar, at most every `mininterval`
+        tqdm(total=total_files, desc="Processing", mininterval=0.5) as pbar,
+    ):
+
+        def collect(futures):
+            nonlocal success
+            for future in futures:
+                isuccess, ierrs = future.result()
                 success += isuccess
+                errs.extend(ierrs)
+                pbar.set_postfix({"success": success}, refresh=False)
                 pbar.update(isuccess)
-                pbar.set_postfix({"success": success})
 
+        # bounded window of batches in flight, only those batches are copied
+        # out of file_paths and queued for the workers
+        in_flight = set()
+        for batch in batch_generator(file_paths, batch_size):
+            if len(in_flight) >= max_workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(_process_batch, batch, dest_base))
+        collect(as_completed(in_flight))
+
+    if errs:
+        logger.error(f"{len(errs)} files failed, see errors.txt")
+        write_errors(errs)
     logger.info(f"Mseed2sac complete. Success: {success}/{total_files}")
     print(f"All done! Check {_LOG_MSEED2SAC['file']}")
 
 
-def _process_batch(file_paths: list[Path], dest_dir: Path) -> int:
+def _day_key(path: Path) -> tuple[str, ...]:
+    """(net, sta, year, day) of an SDS name, else the source directory"""
+    match = _SDS_NAME_RE.fullmatch(path.name)
+    if match is None:
+        return ("", *path.parent.parts)
+    return match.group("net", "sta", "year", "day")
+
+
+def _process_batch(file_paths: list[Path], dest_dir: Path) -> tuple[int, list[str]]:
     """处理单个批次"""
     logger = get_logger(**_LOG_MSEED2SAC)
+    # destination of every file, from the SDS name when possible, otherwise
+    # from a header-only read; samples are decoded later
+    index = {}
+    sds_dirs = {}
+    for path in file_paths:
+        match = _SDS_NAME_RE.fullmatch(path.name)
+        if match is not None:
+            net, sta, year, day = match.group("net", "sta", "year", "day")
+            sds_dirs[path] = _day_dir(dest_dir, net, sta, year, day)
+            continue
+        try:
+            index[path] = _destination_paths(path, dest_dir)
+        except Exception:
+            pass  # reported by `mseed2sac` below
+    # create every day directory of the batch once, before any write
+    dirs = {dest.parent for dests in index.values() for dest in dests}
+    dirs.update(sds_dirs.values())
+    for dir_path in sorted(dirs, key=lambda p: len(p.parts)):
+        dir_path.mkdir(parents=True, exist_ok=True)
+    # output names start with the SDS name, headers are only needed to
+    # check files a previous run may have converted
+    listed = {}
+    for path, dir_path in sds_dirs.items():
+        if dir_path not in listed:
+            listed[dir_path] = os.listdir(dir_path)
+        prefix = f"{path.name}."
+        if not any(name.startswith(prefix) for name in listed[dir_path]):
+            index[path] = []
+
     success = 0
+    errs = []
     for path in file_paths:
         try:
-            mseed2sac(path, dest_dir)
+            mseed2sac(path, dest_dir, index.get(path))
             success += 1
         except TypeError as e:
-            logger.error(f"Failed read {path.name}: {str(e)}")
+            logger.warning(f"Failed read {path.name}: {str(e)}")
+            errs.append(f"Failed read {path}: {e!r}")
         except Exception as e:
-            logger.error(f"Failed {path.name}: {str(e)}", exc_info=True)
-    return success
+            logger.warning(f"Failed {path.name}: {str(e)}")
+            errs.append(f"Failed {path}: {e!r}")
+    return success, errs
 
 
-def mseed2sac(mseed_path: Path, dest_base: Path) -> None:
-    """转换单个文件"""
+def mseed2sac(
+    mseed_path: Path, dest_base: Path, dest_paths: list[Path] | None = None
+) -> None:
+    """转换单个文件
+
+    `dest_paths` from `_destination_paths` whose directories exist already,
+    found by a header-only read here when not given; empty when nothing of
+    the file is converted yet.
+    """
     logger = get_logger(**_LOG_MSEED2SAC)
 
-    stream = obspy.read(mseed_path)
-    stream.merge(method=1, fill_value="interpolate")
+    if dest_paths is None:
+        dest_paths = _destination_paths(mseed_path, dest_base)
+        for dest_path in dest_paths:
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+    if _is_converted(mseed_path, dest_paths):
+        logger.debug("Skipped converted: %s", mseed_path.name)
+        return
+
+    stream = _merge(obspy.read(mseed_path, format="MSEED"))
 
     for trace in stream:
         stats = trace.stats
@@ -99,8 +194,81 @@ def mseed2sac(mseed_path: Path, dest_base: Path) -> None:
             dest_base=dest_base,
         )
 
-        trace.write(str(dest_path), format="SAC")
-    logger.debug(f"Converted: {mseed_path.name} -> {dest_path.parent}")
+        # skip the plugin dispatch of `Trace.write`, same little endian output
+        sac = SACTrace.from_obspy_trace(trace)
+        try:
+            sac.write(str(dest_path), byteorder="little")
+        except FileNotFoundError:
+            # first record before midnight, the day differs from the file name
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            sac.write(str(dest_path), byteorder="little")
+    logger.debug("Converted: %s -> %s", mseed_path.name, dest_path.parent)
+
+
+def _merge(stream: obspy.Stream) -> obspy.Stream:
+    """`stream.merge(method=1, fill_value="interpolate")` for records in a row
+
+    Contiguous records of an id (the usual miniseed case) are joined with a
+    single `np.concatenate`; ids with gaps, overlaps or mixed sampling go
+    through ObsPy's merge.
+    """
+    groups = {}
+    for trace in stream:
+        groups.setdefault(trace.id, []).append(trace)
+    merged = obspy.Stream()
+    for traces in groups.values():
+        traces.sort(key=lambda tr: tr.stats.starttime)
+        first = traces[0]
+        delta = first.stats.delta
+        if all(
+            tr.stats.sampling_rate == first.stats.sampling_rate
+            and tr.data.dtype == first.data.dtype
+            and abs(tr.stats.starttime - prev.stats.endtime - delta) < delta / 100
+            for prev, tr in zip(traces, traces[1:])
+        ):
+            if len(traces) > 1:
+                first.data = np.concatenate([tr.data for tr in traces])
+            merged.append(first)
+        else:
+            merged += obspy.Stream(traces).merge(method=1, fill_value="interpolate")
+    return merged
+
+
+def _is_converted(mseed_path: Path, dest_paths: list[Path]) -> bool:
+    """every merged trace already has a SAC file newer than the source"""
+    src_mtime = os.stat(mseed_path).st_mtime
+    for dest_path in dest_paths:
+        try:
+            if os.stat(dest_path).st_mtime < src_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return bool(dest_paths)
+
+
+def _destination_paths(mseed_path: Path, dest_base: Path) -> list[Path]:
+    """SAC paths `mseed2sac` writes for a file
+
+    Only headers are read, the merged trace of an id starts at its earliest
+    record, so destination names are known without decoding samples.
+    """
+    firsts = {}
+    for trace in obspy.read(mseed_path, format="MSEED", headonly=True):
+        first = firsts.get(trace.id)
+        if first is None or trace.stats.starttime < first.starttime:
+            firsts[trace.id] = trace.stats
+    return [
+        build_destination_path(
+            network=stats.network,
+            station=stats.station,
+            starttime=stats.starttime,
+            location=stats.location,
+            channel=stats.channel,
+            data_quality=stats.mseed.dataquality,
+            dest_base=dest_base,
+        )
+        for stats in firsts.values()
+    ]
 
 
 def build_destination_path(
@@ -140,19 +308,22 @@ def build_destination_path(
     1. "khole" must be setted.
     2. Every sac name must be unique for "db" and "done" file
     """
-    year = starttime.year
-    julday = starttime.julday
-    time = starttime.strftime("%H%M%S")
-
-    dir_path = dest_base / f"{network}/{station}/{year:04d}/{julday:03d}"
-    dir_path.mkdir(parents=True, exist_ok=True)
+    year = f"{starttime.year:04d}"
+    julday = f"{starttime.julday:03d}"
+    time = f"{starttime.hour:02d}{starttime.minute:02d}{starttime.second:02d}"
 
-    filename = (
-        f"{network}.{station}.{location}.{channel}."
-        f"{data_quality}.{year:04d}.{julday:03d}.{time}.sac"
+    dir_path = _day_dir(dest_base, network, station, year, julday)
+    filename = ".".join(
+        [network, station, location, channel, data_quality, year, julday, time, "sac"]
     )
     return dir_path / filename
 
 
+@lru_cache(maxsize=65536)
+def _day_dir(dest_base: Path, network: str, station: str, year: str, julday: str):
+    """day directory, shared by every trace and file of the same day"""
+    return dest_base.joinpath(network, station, year, julday)
+
+
 if __name__ == "__main__":
     mseed2sac_dir("data/perm_test", "data/perm_dest", pattern="*HH*.D")
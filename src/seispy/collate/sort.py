@@ -1,14 +1,38 @@
+import logging
+import os
+import re
 import shutil
-import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from pathlib import Path
 
-from icecream import ic
-from rose import batch_generator, pather
+from rose import batch_generator, get_logger, pather, write_errors
 from tqdm import tqdm
 
+_LOG_SORT = {
+    "name": "sort",
+    "file": "sort.log",
+    "level": logging.INFO,
+}
 
-def sort_to(src: str | Path, dest: str | Path, pattern: str = "*.SAC"):
+# change this pattern to parse filename: net.sta.loc.cha.quality.year.day.time
+_NAME_RE = re.compile(
+    r"(?P<net>[^.]+)\.(?P<sta>[^.]+)\.[^.]*\.[^.]*\.[^.]*\."
+    r"(?P<year>\d{4})\.(?P<day>\d{3})\."
+)
+
+
+def sort_to(
+    src: str | Path,
+    dest: str | Path,
+    pattern: str = "*.SAC",
+    max_workers: int | None = None,
+    link: bool = False,
+):
     """copy source and sort structure of destnation
 
     Sort files from `mseed2sac` to the structure like `/net/sta/year/day`.
@@ -18,6 +42,10 @@ def sort_to(src: str | Path, dest: str | Path, pattern: str = "*.SAC"):
         src_dir: source directory
         dest_dir: destination directory
         pattern: search pattern of target files
+        max_workers: copy threads, defaults to 4 per CPU and at least 32 (I/O bound)
+        link: hard link instead of copy when dest is on the same filesystem,
+            the sorted files then share data with the sources (edit neither
+            in place)
 
     Examples:
         >>>import seispy
@@ -25,23 +53,81 @@ def sort_to(src: str | Path, dest: str | Path, pattern: str = "*.SAC"):
     """
     src_path = Path(src)
     dest_path = Path(dest)
-    targets = pather.glob(src_path, "rglob", [pattern])
-    batch_size = 2000
-    with ProcessPoolExecutor(max_workers=5) as executor:
-        futures = {
-            executor.submit(_copy_targets, batch, dest_path)
-            for batch in batch_generator(targets, batch_size)
-        }
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            future.result()
-    ic(f"All done. Sorted `{src}` to `{dest}`.")
-
-
-def _copy_targets(targets: list[Path], dest_path: Path):
-    for target in targets:
-        # change these parts to parse filename.
-        net, sta, _, _, _, year, day, _ = target.stem.split(".")
-        dest_file = dest_path / net / sta / year / day / target.name
-        dest_file.parent.mkdir(parents=True, exist_ok=True)
+    targets = pather.scan_files(src_path, pattern)
+    batch_size = 512
+    # enough outstanding copies to fill an NVMe queue even on small hosts
+    max_workers = max_workers or max(32, (os.cpu_count() or 1) * 4)
+    errs = []
+    # bounded window of batches in flight, paths are streamed from the walk
+    in_flight = {}
+    with (
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+        tqdm(desc="Sorting", unit="file", smoothing=0) as pbar,
+    ):
+        for batch in batch_generator(targets, batch_size):
+            if len(in_flight) >= max_workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    errs += future.result()
+                    pbar.update(in_flight.pop(future))
+            future = executor.submit(_copy_targets, batch, dest_path, link)
+            in_flight[future] = len(batch)
+        for future in as_completed(in_flight):
+            errs += future.result()
+            pbar.update(in_flight[future])
+    if errs:
+        write_errors(errs)
+    get_logger(**_LOG_SORT).info(f"Sorted `{src}` to `{dest}`, {len(errs)} skipped.")
+    print(f"All done. Sorted `{src}` to `{dest}`.")
+
+
+def _copy_targets(targets: list[str], dest_path: Path, link: bool) -> list[str]:
+    copies = []
+    errs = []
+    for target in map(Path, targets):
+        match = _NAME_RE.match(target.name)
+        if match is None:
+            errs.append(f"Skipped unexpected filename: {target}")
+            continue
+        net, sta, year, day = match.group("net", "sta", "year", "day")
+        copies.append((dest_path / net / sta / year / day, target))
+    # group by day directory, each one is created once
+    copies.sort(key=lambda copy: copy[0])
+
+    made_dirs = set()
+    for dest_dir, target in copies:
+        if dest_dir not in made_dirs:
+            dest_dir.mkdir(parents=True, exist_ok=True)
+            made_dirs.add(dest_dir)
+        dest_file = dest_dir / target.name
+        if _is_copied(target, dest_file):
+            continue
+        if link and _hard_link(target, dest_file):
+            continue
         shutil.copy(target, dest_file)
-    time.sleep(0.1)
+    return errs
+
+
+def _hard_link(src: Path, dst: Path) -> bool:
+    """O(1) metadata-only copy, False across filesystems"""
+    try:
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            # stale file of a previous run, replaced once
+            os.unlink(dst)
+            os.link(src, dst)
+    except OSError:  # EXDEV, or no hard links on this filesystem
+        return False
+    return True
+
+
+def _is_copied(src: Path, dst: Path) -> bool:
+    """dst left by a previous run, same size and not older than src"""
+    try:
+        dst_st = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_st = os.stat(src)
+    return dst_st.st_size == src_st.st_size and dst_st.st_mtime >= src_st.st_mtime
+
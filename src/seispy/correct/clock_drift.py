@@ -1,18 +1,25 @@
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
+import numpy as np
 import obspy
 import pandas as pd
 from obspy import UTCDateTime
-from rose import get_logger
+from rose import get_logger, pather
 from tqdm import tqdm
 
 _LOG_DRIFT = {
     "name": "correct",
     "file": "correct.log",
     "level": logging.INFO,
+    "multiprocess": True,
 }
+_DAY_RE = re.compile(r"\.(\d{4})\.(\d{3})\.")
 
 
 def clock_drift(src_dir: str, dest_dir:str, drift_csv: str, max_workers: int = 4):
@@ -35,27 +42,32 @@ def clock_drift(src_dir: str, dest_dir:str, drift_csv: str, max_workers: int = 4
     valid_stations = _get_valid_stations(src_dir, drift_data.keys())
     logger.info(f"Found {len(valid_stations)} valid stations with drift data")
 
-    # 并行处理每个台站
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # 提交所有任务
-        future_to_station = {
-            executor.submit(
-                _process_station_drift_correction,
-                station, drift_data[station], src_dir, dest_dir
-            ): station for station in valid_stations
-        }
-        
-        with tqdm(total=len(valid_stations), desc="Processing stations") as pbar:
-            for future in as_completed(future_to_station):
-                station = future_to_station[future]
-                try:
-                    future.result()
-                    pbar.update(1)
-                    pbar.set_postfix_str(f"Completed: {station}")
-                except Exception as e:
-                    logger.error(f"Failed to process station {station}: {str(e)}")
-                    pbar.update(1)
-    
+    # 按文件分块并行, 文件数悬殊的台站也能均衡到各进程
+    # 文件名中的 .year.day. 超出钟漂时间范围的文件不再读取
+    day_ranges = {sta: _day_range(drift_data[sta]) for sta in valid_stations}
+    tasks = [
+        (Path(sac_file), station)
+        for station in valid_stations
+        for sac_file in pather.scan_files(Path(src_dir) / station, "*.sac")
+        if _day_in_range(os.path.basename(sac_file), *day_ranges[station])
+    ]
+    sac_files = [sac_file for sac_file, _ in tasks]
+    drifts = [drift_data[station] for _, station in tasks]
+    chunksize = max(1, len(tasks) // (max_workers * 4))
+    correct = partial(_correct_file, src_dir=src_dir, dest_dir=dest_dir)
+
+    processed = Counter()
+    with (
+        ProcessPoolExecutor(max_workers=max_workers) as executor,
+        tqdm(total=len(tasks), desc="Processing files") as pbar,
+    ):
+        results = executor.map(correct, sac_files, drifts, chunksize=chunksize)
+        for (_, station), done in zip(tasks, results):
+            processed[station] += done
+            pbar.update(1)
+
+    for station in valid_stations:
+        logger.info(f"{station} complete, total {processed[station]} files processed.")
     logger.info("Drift correction complete!")
 
 
@@ -70,15 +82,24 @@ def _load_drift_data(drift_csv):
         }
     )
     
-    return {
-        row["station"]: {
-            "reference_time": UTCDateTime(row["starttime"]),
-            "drift": float(row["drift"]),
-            "drift_rate": float(row["drift_rate"]),
-            "starttime": UTCDateTime(row["starttime"]),
-            "endtime": UTCDateTime(row["endtime"]),
-        } for _, row in df.iterrows()
-    }
+    drift_data = {}
+    for station, starttime, endtime, drift, drift_rate in zip(
+        df["station"],
+        df["starttime"],
+        df["endtime"],
+        df["drift"].tolist(),
+        df["drift_rate"].tolist(),
+    ):
+        # 参考时间即起始时间, 共用同一个对象
+        starttime = UTCDateTime(starttime)
+        drift_data[station] = {
+            "reference_time": starttime,
+            "drift": drift,
+            "drift_rate": drift_rate,
+            "starttime": starttime,
+            "endtime": UTCDateTime(endtime),
+        }
+    return drift_data
 
 
 def _get_valid_stations(src_dir, drift_stations):
@@ -87,48 +108,53 @@ def _get_valid_stations(src_dir, drift_stations):
     return [sta for sta in drift_stations if (src_path / sta).exists()]
 
 
-def _process_station_drift_correction(station_name, station_drift, src_dir, dest_dir):
-    """处理单个台站的钟漂修正"""
-    logger = get_logger(**_LOG_DRIFT)
-    
-    # 获取该台站的所有SAC文件
-    station_path = Path(src_dir) / station_name
-    
-    processed_count = 0
-    # 处理每个SAC文件
-    for sac_file in station_path.rglob("*.sac"):
-        try:
-            st = obspy.read(sac_file)
-            
-            # 检查文件时间是否在钟漂数据时间范围内
-            sac_time = st[0].stats.starttime
-            if not (station_drift["starttime"] <= sac_time <= station_drift["endtime"]):
-                continue
-            
-            # 应用钟漂修正
-            _apply_drift_correction(st, station_drift)
-            # 保存修正后的文件
-            _save_corrected_file(st, sac_file, src_dir, dest_dir)
-
-            processed_count += 1
-            
-        except Exception as e:
-            logger.error(f"Error processing {sac_file}: {str(e)}")
-
-    logger.info(f"{station_name} complete, total {processed_count} files processed.")
-    
+def _day_range(station_drift):
+    """钟漂范围前后各放宽一天的 (year, julday)"""
+    first = station_drift["starttime"] - 86400
+    last = station_drift["endtime"] + 86400
+    return (first.year, first.julday), (last.year, last.julday)
+
+
+def _day_in_range(filename, first, last) -> bool:
+    """文件名日期在范围内, 无日期的文件交给读取后判断"""
+    match = _DAY_RE.search(filename)
+    if match is None:
+        return True
+    return first <= (int(match[1]), int(match[2])) <= last
+
+
+def _correct_file(sac_file, station_drift, src_dir, dest_dir) -> bool:
+    """处理单个SAC文件的钟漂修正, 返回是否写出"""
+    try:
+        st = obspy.read(sac_file)
+
+        # 检查文件时间是否在钟漂数据时间范围内
+        sac_time = st[0].stats.starttime
+        if not (station_drift["starttime"] <= sac_time <= station_drift["endtime"]):
+            return False
+
+        # 应用钟漂修正
+        _apply_drift_correction(st, station_drift)
+        # 保存修正后的文件
+        _save_corrected_file(st, sac_file, src_dir, dest_dir)
+        return True
+
+    except Exception as e:
+        get_logger(**_LOG_DRIFT).error(f"Error processing {sac_file}: {str(e)}")
+        return False
+
 
 def _apply_drift_correction(stream, station_drift):
     drift_rate = station_drift["drift_rate"]
-    reference_time = station_drift["reference_time"]
-    
-    for tr in stream:
-        # 计算中间时间和钟漂修正量
-        duration = tr.stats.endtime - tr.stats.starttime
-        mid_time = tr.stats.starttime + duration / 2
-        correction = drift_rate * (mid_time - reference_time)
-        
-        # 直接平移整个trace的时间轴
+    reference = station_drift["reference_time"].timestamp
+
+    # 一次性计算所有trace的中间时间和钟漂修正量
+    starts = np.array([tr.stats.starttime.timestamp for tr in stream])
+    durations = np.array([(tr.stats.npts - 1) * tr.stats.delta for tr in stream])
+    corrections = drift_rate * (starts + durations / 2 - reference)
+
+    # 直接平移整个trace的时间轴
+    for tr, correction in zip(stream, corrections.tolist()):
         tr.stats.starttime -= correction
 
 
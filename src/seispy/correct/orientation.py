@@ -12,6 +12,7 @@ _LOG_DRIFT = {
     "name": "correct",
     "file": "correct.log",
     "level": logging.INFO,
+    "multiprocess": True,
 }
 
 
@@ -1,16 +1,54 @@
 import logging
+import os
+import random
+import threading
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Set, Tuple, Union
 
 import pandas as pd
 from obspy import Stream, UTCDateTime
 from obspy.clients.fdsn import Client
-from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.clients.fdsn.header import (
+    FDSNNoDataException,
+    FDSNServiceUnavailableException,
+    FDSNTimeoutException,
+    FDSNTooManyRequestsException,
+)
+from obspy.clients.fdsn.mass_downloader import (
+    GlobalDomain,
+    MassDownloader,
+    Restrictions,
+)
+from rose import batch_generator, pather
 from tqdm import tqdm
 
 LOG_FILE_DOWNLOAD = "download.log"
+# 服务端限流或过载, 退避后重试
+_RETRYABLE = (
+    FDSNTooManyRequestsException,
+    FDSNServiceUnavailableException,
+    FDSNTimeoutException,
+)
+
+
+class _RateLimiter:
+    """相邻两次请求至少间隔 interval 秒, 线程安全"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
 
 
 class IRISDownloader:
@@ -31,7 +69,10 @@ class IRISDownloader:
             "location": "*",
             "channel": "*",
             "max_workers": 5,  # 建议不超过6
+            "max_inflight": 5,  # 同时进行的请求数, IRIS 限制单用户并发连接
+            "max_retries": 5,  # 429/503/超时 的最大尝试次数
             "request_interval": 0.2,  # 请求间隔（秒），控制QPS≈0.83
+            "bulk_size": 100,  # 每次批量请求的 (台站, 日期) 数
             **config,  # 用户配置覆盖默认
         }
         self.connection_params = {
@@ -39,16 +80,12 @@ class IRISDownloader:
             "user": self.config["email"],
             "password": self.config["token"],
         }
-        # self.client = Client(
-        #     "IRIS",
-        #     user=self.config["email"],
-        #     password=self.config["token"],
-        #     # user_agent=f"SUSTech_SeismoLab/1.0 ({self.config['email']})",
-        # )
-
+        # 请求间隔对所有下载线程生效, 而不是每个线程各自等待
+        self._rate_limiter = _RateLimiter(self.config["request_interval"])
+        # 网络并发与线程数 (含写SAC) 分开控制
+        self._inflight = threading.BoundedSemaphore(self.config["max_inflight"])
         self._validate_dates()
         # self._init_stations()
-        self.executor = ProcessPoolExecutor(max_workers=self.config["max_workers"])
 
     def _validate_dates(self):
         """验证并初始化日期范围"""
@@ -67,10 +104,9 @@ class IRISDownloader:
     def _get_stations(self) -> List[str]:
         """获取台站列表（如果用户未提供）"""
         self.logger.info("Fetching station list...")
-        client = self._create_client(self.connection_params)
 
         try:
-            inventory = client.get_stations(
+            inventory = self.client.get_stations(
                 network=self.config["network"],
                 station=self.config["station"],
                 starttime=self.start_date,
@@ -99,13 +135,8 @@ class IRISDownloader:
             f"{stats.starttime.year}.{stats.starttime.julday:03d}.sac"
         )
 
-    def _process_single_station_day(
-        self, client: Client, day: UTCDateTime, station: str, base_path: Path
-    ) -> bool:
-        """处理单个台站单日数据下载"""
-        day_str = day.strftime("%Y-%m-%d")
-        self.logger.debug(f"Processing: {station}/{day_str}")
-        save_path = (
+    def _save_path(self, base_path: Path, station: str, day: UTCDateTime) -> Path:
+        return (
             base_path
             / self.config["network"]
             / station
@@ -113,62 +144,110 @@ class IRISDownloader:
             / f"{day.julday:03d}"
         )
 
-        # 跳过已存在数据的目录
-        if save_path.exists() and any(save_path.iterdir()):
-            self.logger.info(f"Exists: {station}/{day_str}")
-            return True
+    @staticmethod
+    def _existing_days(network_path: Path) -> Set[Tuple[str, int, int]]:
+        """一次遍历输出目录, 收集已有数据的 (台站, 年, 儒略日)"""
+        existing = set()
+        if not network_path.is_dir():
+            return existing
+        root = os.fspath(network_path)
+        for entry in pather.scandir_recursive(root):
+            parts = os.path.relpath(os.path.dirname(entry.path), root).split(os.sep)
+            if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                existing.add((parts[0], int(parts[1]), int(parts[2])))
+        return existing
+
+    def _process_bulk(
+        self,
+        client: Client,
+        tasks: List[Tuple[str, UTCDateTime]],
+        base_path: Path,
+    ) -> int:
+        """一次批量请求下载多个 (台站, 日期), 返回成功的任务数"""
+        first, last = tasks[0][1], tasks[-1][1]
+        days_str = f"{first.strftime('%Y-%m-%d')}~{last.strftime('%Y-%m-%d')}"
+        self.logger.debug(f"Processing: {len(tasks)} station days of {days_str}")
+        bulk = [
+            (
+                self.config["network"],
+                station,
+                self.config["location"],
+                self.config["channel"],
+                day,
+                day + 86400,
+            )
+            for station, day in tasks
+        ]
 
         try:
-            # 遵守API请求频率限制
-            time.sleep(self.config["request_interval"])
-
-            stream = self.client.get_waveforms(
-                network=self.config["network"],
-                station=station,
-                location=self.config["location"],
-                channel=self.config["channel"],
-                starttime=day,
-                endtime=day + 86400,
+            stream = self._fetch_bulk(client, bulk)
+        except FDSNNoDataException:
+            self.logger.warning(f"No Data: {len(tasks)} station days of {days_str}")
+            return 0
+        except Exception as e:
+            self.logger.error(f"Download failed: {days_str}: {str(e)}")
+            return 0
+
+        # 按请求的台站和日期切回各天, 连续的记录在返回的流中已合并为跨天的trace
+        if not isinstance(stream, Stream):
+            stream = Stream()
+        written = 0
+        for station, day in tasks:
+            task_str = f"{station}/{day.strftime('%Y-%m-%d')}"
+            day_stream = stream.select(station=station).slice(
+                day, day + 86400, nearest_sample=False
             )
-
-            if not isinstance(stream, Stream) or len(stream) == 0:
-                self.logger.warning(f"No Data: {station}/{day_str}")
-                return False
-
-            save_path.mkdir(parents=True, exist_ok=True)
-            for trace in stream:
+            traces = [
+                trace
+                for trace in day_stream
+                if trace.stats.npts and trace.stats.starttime < day + 86400
+            ]
+            if not traces:
+                self.logger.warning(f"No Data: {task_str}")
+                continue
+            save_path = self._save_path(base_path, station, day)
+            save_path.mkdir(exist_ok=True)
+            for trace in traces:
                 filename = self._build_filename(trace.stats)
                 trace.write(str(save_path / filename), format="SAC")
-
-            self.logger.debug(f"Downloaded: {station}/{day_str}")
-            return True
-
-        except FDSNNoDataException:
-            self.logger.warning(f"No Data: {station}/{day_str}")
-            return False
-        except Exception as e:
-            self.logger.error(f"Download failed: {station}/{day_str}: {str(e)}")
-            return False
+            written += 1
+            self.logger.debug(f"Downloaded: {task_str}")
+        return written
+
+    def _fetch_bulk(self, client: Client, bulk: List[Tuple]) -> Stream:
+        """批量请求, 限流/过载时指数退避 (带抖动) 重试"""
+        attempts = self.config["max_retries"]
+        for attempt in range(attempts):
+            # 遵守API请求频率限制
+            self._rate_limiter.acquire()
+            try:
+                with self._inflight:
+                    return client.get_waveforms_bulk(bulk)
+            except _RETRYABLE as e:
+                if attempt == attempts - 1:
+                    raise
+                delay = min(60, 2**attempt) + random.uniform(0, 1)
+                self.logger.warning(f"Retry in {delay:.1f}s: {type(e).__name__}")
+                time.sleep(delay)
+
+    @cached_property
+    def client(self) -> Client:
+        """首次使用时创建, 之后所有请求 (含下载线程) 共用"""
+        return self._create_client(self.connection_params)
 
     @staticmethod
     def _create_client(params: Dict) -> Client:
-        """在子进程内创建客户端"""
+        """创建客户端"""
         return Client(
             base_url=params["base_url"],
             user=params["user"],
             password=params["password"],
             user_agent=f"IRISDownloader/1.0 ({params['user']})",
             timeout=30,
+            # IRIS serves the standard FDSN services, skip the WADL probes
+            _discover_services=False,
         )
 
-    @staticmethod
-    def _process_task(args: Tuple) -> bool:
-        """任务处理入口（静态方法避免序列化问题）"""
-        params, config, day, station, base_path = args
-        client = IRISDownloader._create_client(params)
-        downloader = IRISDownloader(config)
-        return downloader._process_single_station_day(client, day, station, base_path)
-
     def wave(self, output_dir: str):
         """启动下载任务"""
         base_path = Path(output_dir)
@@ -178,14 +257,35 @@ class IRISDownloader:
 
         self.logger.info(f"Download start, all {total_tasks} tasks.")
 
-        with tqdm(total=total_tasks, desc="Download progress") as progress_bar:
-            futures = [
-                self.executor.submit(
-                    self._process_single_station_day, day, station, base_path
-                )
-                for station in stations
-                for day in dates
-            ]
+        # network I/O bound: threads share one client instead of one per process
+        client = self.client
+        network_path = base_path / self.config["network"]
+        # 按日期排列, 每个批量请求覆盖同一时段的所有台站
+        # 已存在数据的目录在提交前跳过, 不占用线程和请求间隔
+        existing = self._existing_days(network_path)
+        missing = []
+        for day in dates:
+            for station in stations:
+                if (station, day.year, day.julday) in existing:
+                    self.logger.info(f"Exists: {station}/{day.strftime('%Y-%m-%d')}")
+                else:
+                    missing.append((station, day))
+        # station/year 目录先建好, 下载时只需创建最后一级 julday
+        for station, year in {(station, day.year) for station, day in missing}:
+            (network_path / station / str(year)).mkdir(parents=True, exist_ok=True)
+
+        with (
+            ThreadPoolExecutor(max_workers=self.config["max_workers"]) as executor,
+            tqdm(
+                total=total_tasks,
+                initial=total_tasks - len(missing),
+                desc="Download progress",
+            ) as progress_bar,
+        ):
+            futures = {}
+            for batch in batch_generator(missing, self.config["bulk_size"]):
+                future = executor.submit(self._process_bulk, client, batch, base_path)
+                futures[future] = len(batch)
 
             for future in as_completed(futures):
                 try:
@@ -193,16 +293,52 @@ class IRISDownloader:
                 except Exception as e:
                     self.logger.error(f"Mission failed: {str(e)}")
                 finally:
-                    progress_bar.update(1)
+                    progress_bar.update(futures[future])
+
+        self.logger.info("Mission complete.")
+        print(f"Mission complete. Check {LOG_FILE_DOWNLOAD} for details.")
 
-        self.executor.shutdown()
+    def mass_wave(self, output_dir: str, stationxml_dir: str = "stations"):
+        """使用 obspy MassDownloader 下载, 已存在的文件自动跳过
+
+        目录结构同 `wave`, 但保存为 MiniSEED (.mseed), 需要SAC时再用
+        `mseed2sac_dir` 转换. 同时会下载台站 StationXML 到 stationxml_dir.
+        """
+        base_path = Path(output_dir)
+
+        def mseed_storage(network, station, location, channel, starttime, endtime):
+            return str(
+                self._save_path(base_path, station, starttime)
+                / f"{network}.{station}.{location}.{channel}."
+                f"{starttime.year}.{starttime.julday:03d}.mseed"
+            )
+
+        restrictions = Restrictions(
+            starttime=self.start_date,
+            endtime=self.end_date,
+            chunklength_in_sec=86400,
+            network=self.config["network"],
+            station=",".join(self.config["stations"]),
+            location=self.config["location"],
+            channel=self.config["channel"],
+            reject_channels_with_gaps=False,
+            minimum_length=0.0,
+        )
+        self.logger.info("Mass download start.")
+        MassDownloader(providers=[self.client]).download(
+            GlobalDomain(),
+            restrictions,
+            mseed_storage=mseed_storage,
+            stationxml_storage=stationxml_dir,
+            threads_per_client=self.config["max_inflight"],
+        )
         self.logger.info("Mission complete.")
         print(f"Mission complete. Check {LOG_FILE_DOWNLOAD} for details.")
 
     def response(self, outfile: str, **kwargs):
         self.logger.info("Download response start.")
         try:
-            inventory = self._create_client().get_stations(
+            inventory = self.client.get_stations(
                 network=self.config["network"], level="response", **kwargs
             )
             inventory.write(outfile, format="STATIONXML")
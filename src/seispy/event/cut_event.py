@@ -1,13 +1,17 @@
-import datetime
 import logging
+import multiprocessing
+import os
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from fnmatch import fnmatchcase
 from pathlib import Path
 
 import numpy as np
 import obspy
 import pandas as pd
 from obspy import UTCDateTime
+from obspy.io.sac import SACTrace
 from rose import get_logger, pather
 from tqdm import tqdm
 
@@ -15,10 +19,21 @@ _LOG_CUTEVENT = {
     "file": "cutevent.log",
     "name": "cut_event",
     "level": logging.INFO,
+    "multiprocess": True,
 }
+_WRITE_BUFFER = 1024 * 1024
+_WRITE_THREADS = 2
+_MAX_PENDING_WRITES = 32
 
 
-def cut_events(src_dir, dest_dir, event_csv, station_csv=None, time_window=10800):
+def cut_events(
+    src_dir,
+    dest_dir,
+    event_csv,
+    station_csv=None,
+    time_window=10800,
+    max_workers: int = 4,
+):
     logger = get_logger(**_LOG_CUTEVENT)
     logger.info("Start cutting events...")
 
@@ -28,55 +43,119 @@ def cut_events(src_dir, dest_dir, event_csv, station_csv=None, time_window=10800
     logger.info(f"Found {len(stations)} stations and {len(events)} events.")
 
     total = len(events) * len(stations)
-    with tqdm(total=total, desc="Processing...") as pbar:
-        for station in stations:
-            for event in events:
-                cut_event_station(event, station, src_dir, dest_dir)
-                pbar.update(1)
+    # 按时间顺序处理事件, 每个台站的日数据只读一次
+    events = sorted(events, key=lambda event: event["start"])
+    # 各台站的输入目录和输出文件互不相交, 按台站多进程并行
+    with (
+        ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        ) as executor,
+        tqdm(total=total, desc="Processing...") as pbar,
+    ):
+        futures = [
+            executor.submit(_cut_station_events, station, events, src_dir, dest_dir)
+            for station in stations
+        ]
+        for future in as_completed(futures):
+            future.result()
+            pbar.update(len(events))
     logger.info("Cut events complete.")
     print(f"Cut events complete. Check {_LOG_CUTEVENT['file']} for details.")
 
 
-def cut_event_station(event, station, src_dir, dest_dir):
-    """处理单个事件-台站组合"""
+def _cut_station_events(station, events, src_dir, dest_dir):
+    """处理单个台站的所有事件, events 需按时间排序"""
+    day_cache = {}
+    # 台站目录只遍历一次, 之后按 (year, jday) 直接查找文件
+    day_index = _station_index(src_dir, station["station"])
+    # 写文件交给I/O线程, 本进程接着读取和裁剪下一个事件
+    with _BackgroundWriter(_WRITE_THREADS, _MAX_PENDING_WRITES) as write:
+        for event in events:
+            cut_event_station(
+                event, station, src_dir, dest_dir, day_cache, day_index, write
+            )
+            # 之后的事件不会再用到更早的日数据
+            first = (event["start"].year, f"{event['start'].julday:03d}")
+            for day in [day for day in day_cache if day < first]:
+                del day_cache[day]
+
+
+class _BackgroundWriter:
+    """线程池写SAC, 积压超过 max_pending 个文件时提交方阻塞等待"""
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def __call__(self, trace, out_path):
+        self._slots.acquire()
+        future = self._pool.submit(_write_sac, trace, out_path)
+        future.add_done_callback(lambda f: self._done(f, out_path))
+
+    def _done(self, future, out_path):
+        self._slots.release()
+        if (e := future.exception()) is not None:
+            get_logger(**_LOG_CUTEVENT).error(f"Write {out_path} failed: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._pool.shutdown(wait=True)
+
+
+def _write_sac(trace, out_path):
+    # header and samples reach the disk in a single write
+    with open(out_path, "wb", buffering=_WRITE_BUFFER) as f:
+        trace.write(f, format="SAC")
+
+
+def cut_event_station(
+    event,
+    station,
+    src_dir,
+    dest_dir,
+    day_cache=None,
+    day_index=None,
+    write=_write_sac,
+):
+    """处理单个事件-台站组合
+
+    day_cache: (year, jday) -> 已读取的traces, 同一台站的多个事件共用
+    day_index: (year, jday) -> SAC路径, 见 `_station_index`
+    write: write(trace, out_path), 默认直接写出, 见 `_BackgroundWriter`
+    """
     logger = get_logger(**_LOG_CUTEVENT)
+    if day_cache is None:
+        day_cache = {}
     # 生成时间覆盖范围
     year_jdays = _calculate_julian_dates(event["start"], event["end"])
 
-    # 获取所有可能相关的SAC文件路径
+    # 获取所有相关的trace, 未缓存的日数据才读取
     station_name = station["station"]
-    sac_files = _target_paths(src_dir, station_name, year_jdays)
-    if not sac_files:
+    traces = []
+    for year, jday in year_jdays:
+        if (year, jday) not in day_cache:
+            if day_index is None:
+                sac_paths = _target_paths(src_dir, station_name, [(year, jday)])
+            else:
+                sac_paths = day_index.get((year, jday), [])
+            day_cache[(year, jday)] = _read_day(sac_paths, station_name)
+        traces += day_cache[(year, jday)]
+    if not traces:
         logger.warning(
             f"No SAC files found for {station_name=} {event['start']=}."
             "Expect sac name like `*.{year}.{jday}.*.sac`."
         )
 
     # collect all channels data
+    # slice 只是数据视图加上复制的 stats, 缓存的 trace 不会被修改
     channel_data = {}
-
-    for sac_path in sac_files:
-        try:
-            # 精确读取所需数据段
-            st = obspy.read(sac_path)
-            tr = st[0]
-
-            sta = tr.stats.station
-            # check station
-            if sta != station["station"]:
-                logger.error(f"File name mismatch: {sac_path}.")
-                continue
-
-            channel = tr.stats.channel
-
-            # 合并通道数据
-            if channel in channel_data:
-                channel_data[channel] += st
-            else:
-                channel_data[channel] = st
-
-        except Exception as e:
-            logger.error(f"Error processing file {sac_path}: {e}")
+    for tr in traces:
+        sliced = tr.slice(event["start"], event["end"])
+        if sliced.stats.npts:
+            channel_data.setdefault(tr.stats.channel, obspy.Stream()).append(sliced)
 
     # save channel data
     if channel_data:
@@ -90,26 +169,55 @@ def cut_event_station(event, station, src_dir, dest_dir):
                 merged_tr = merged_st[0]
                 trimed_tr = _trimed_trace(merged_tr, event, station)
                 out_name = f"{event_name}.{station_name}.{channel}.sac"
-                trimed_tr.write(str(event_dir / out_name), format="SAC")
+                write(trimed_tr, event_dir / out_name)
             except Exception as e:
                 logger.error(f"{event_name} {channel} failed: {e}")
 
 
+def _read_day(sac_paths, station_name) -> list:
+    """读取台站一天的所有SAC文件"""
+    logger = get_logger(**_LOG_CUTEVENT)
+    traces = []
+    for sac_path in sac_paths:
+        try:
+            st = _read_sac_hinted(sac_path)
+            # check station
+            if st[0].stats.station != station_name:
+                logger.error(f"File name mismatch: {sac_path}.")
+                continue
+            traces += st
+        except Exception as e:
+            logger.error(f"Error processing file {sac_path}: {e}")
+    return traces
+
+
+def _read_sac_hinted(path):
+    """顺序读取整个文件, 读完后释放其页缓存
+
+    日数据每次运行只读一次, 留在页缓存里只会挤掉之后要读的文件
+    """
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):  # linux only
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        st = obspy.read(f)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return st
+
+
 def _trimed_trace(merged_tr, event, station):
-    # delta
-    delta = np.float16(merged_tr.stats.delta)
-    merged_tr.stats.delta = delta
     # trim to event time window
     trimed_tr = merged_tr.trim(event["start"], event["end"], nearest_sample=True)
 
     # header information
     data = trimed_tr.data
     npts = len(data)
-    delta = trimed_tr.stats.delta
+    delta = float(trimed_tr.stats.delta)
     if npts == 0:
         raise ValueError("Empty data after trim")
     start = trimed_tr.stats.starttime
     time_offset = start - event["start"]
+    depmin, depmax, depmen = _depstats(data)
 
     # update header
     if not trimed_tr.stats.location:
@@ -118,9 +226,9 @@ def _trimed_trace(merged_tr, event, station):
         "delta": delta,
         "b": float(time_offset),
         "e": float(time_offset) + (npts - 1) * delta,
-        "depmin": np.min(data),
-        "depmax": np.max(data),
-        "depmen": np.mean(data),
+        "depmin": depmin,
+        "depmax": depmax,
+        "depmen": depmen,
         "nzyear": start.year,
         "nzjday": start.julday,
         "nzhour": start.hour,
@@ -146,6 +254,17 @@ def _trimed_trace(merged_tr, event, station):
     return trimed_tr
 
 
+def _depstats(data, block=32768):
+    """min, max and mean in one sweep, each block is reduced while in cache"""
+    depmin, depmax, total = np.inf, -np.inf, 0.0
+    for i in range(0, len(data), block):
+        chunk = data[i : i + block]
+        depmin = min(depmin, float(chunk.min()))
+        depmax = max(depmax, float(chunk.max()))
+        total += float(chunk.sum(dtype=np.float64))
+    return depmin, depmax, total / len(data)
+
+
 def _load_events(catalog, time_window):
     df = pd.read_csv(
         catalog,
@@ -159,17 +278,22 @@ def _load_events(catalog, time_window):
     )
 
     events = []
-    for _, row in df.iterrows():
-        starttime = UTCDateTime(int(row["time"].timestamp()))  # 对齐到整数秒
-
+    for time, latitude, longitude, depth, mag in zip(
+        df["time"],
+        df["latitude"].tolist(),
+        df["longitude"].tolist(),
+        df["depth"].tolist(),
+        df["mag"].tolist(),
+    ):
+        starttime = UTCDateTime(int(time.timestamp()))  # 对齐到整数秒
         events.append(
             {
                 "start": starttime,
                 "end": starttime + time_window,
-                "latitude": float(row["latitude"]),
-                "longitude": float(row["longitude"]),
-                "depth": float(row["depth"]),
-                "mag": float(row["mag"]),
+                "latitude": latitude,
+                "longitude": longitude,
+                "depth": depth,
+                "mag": mag,
             }
         )
     return events
@@ -185,7 +309,7 @@ def _load_stations(src_dir, station_csv) -> list[dict]:
     :raises ValueError: 当CSV与目录台站不匹配时
     """
     # get all stations under src_dir
-    target_stations = {d.name for d in Path(src_dir).iterdir() if d.is_dir()}
+    target_stations = {entry.name for entry in _station_dirs(src_dir)}
     if not station_csv:
         return [{"station": s} for s in target_stations]
 
@@ -203,17 +327,20 @@ def _load_stations(src_dir, station_csv) -> list[dict]:
 
 def _calculate_julian_dates(start, end):
     """计算时间范围内包含的所有儒略日"""
-    dates = set()
-    current = start.datetime
-    end = end.datetime
-
-    while current <= end:
-        year = current.year
-        jday = current.timetuple().tm_yday
-        dates.add((year, f"{jday:03d}"))
-        current += datetime.timedelta(days=1)
-
-    return sorted(dates)
+    first = (start.year, f"{start.julday:03d}")
+    last = (end.year, f"{end.julday:03d}")
+    # 常见情况: 时间窗不超过一天, 最多跨一次午夜
+    if first == last:
+        return [first]
+    if end - start <= 86400:
+        return [first, last]
+
+    dates = []
+    day = UTCDateTime(year=start.year, julday=start.julday)
+    while day <= end:
+        dates.append((day.year, f"{day.julday:03d}"))
+        day += 86400
+    return dates
 
 
 def _target_paths(sac_base, station, year_jdays):
@@ -221,25 +348,67 @@ def _target_paths(sac_base, station, year_jdays):
     valid_paths = []
     for year, jday in year_jdays:
         dir_path = Path(sac_base) / station / str(year) / jday
-        if not dir_path.exists():
-            continue
-
         # 预期文件名模式：*.{year}.{jday}.*.sac
         pattern = f"*.{year}.{jday}.*.sac"
-        valid_paths.extend(dir_path.glob(pattern))
+        try:
+            with os.scandir(dir_path) as it:
+                valid_paths.extend(
+                    dir_path / entry.name
+                    for entry in it
+                    if fnmatchcase(entry.name, pattern)
+                )
+        except FileNotFoundError:
+            continue
 
     return valid_paths
 
 
+def _station_index(sac_base, station) -> dict[tuple[int, str], list[Path]]:
+    """遍历一次台站目录, 建立 (year, jday) -> SAC路径 索引
+
+    目录结构与文件名模式同 `_target_paths`
+    """
+    index = {}
+    try:
+        with os.scandir(Path(sac_base) / station) as years:
+            year_dirs = [e for e in years if e.is_dir() and e.name.isdigit()]
+    except FileNotFoundError:
+        return index
+    for year_dir in year_dirs:
+        with os.scandir(year_dir.path) as jdays:
+            jday_dirs = [e for e in jdays if e.is_dir()]
+        for jday_dir in jday_dirs:
+            pattern = f"*.{year_dir.name}.{jday_dir.name}.*.sac"
+            with os.scandir(jday_dir.path) as it:
+                paths = [
+                    Path(entry.path) for entry in it if fnmatchcase(entry.name, pattern)
+                ]
+            if paths:
+                index[(int(year_dir.name), jday_dir.name)] = paths
+    return index
+
+
+def _station_dirs(src_dir) -> list[os.DirEntry]:
+    """src_dir 下的台站目录 (含指向目录的符号链接), 只有链接需要额外 stat"""
+    with os.scandir(src_dir) as it:
+        return [entry for entry in it if entry.is_dir()]
+
+
 def cut_events_bin(
     src_dir: str,
     dest_dir: str,
     evtf: str,
     time_window: int = 10800,
     max_workers: int = 4,
+    fix_khole: bool = True,
 ) -> None:
+    """cut events with `mktraceiodb` and `cutevent`
+
+    fix_khole: set empty khole to "10" first (header only), archives already
+    fixed by a previous run can skip this scan.
+    """
     src_path = Path(src_dir)
-    station_paths = list(src_path.glob("*/"))
+    station_paths = [Path(entry.path) for entry in _station_dirs(src_path)]
     total = len(station_paths)
 
     # binarary
@@ -258,12 +427,16 @@ def cut_events_bin(
                 evtf,
                 time_window,
                 dest_dir,
+                fix_khole,
             )
             for id, sta_path in enumerate(station_paths)
         }
         with tqdm(total=total, desc="Processing stations") as pbar:
             for future in as_completed(futures):
-                future.result()
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as e:
+                    get_logger(**_LOG_CUTEVENT).error(f"cutevent failed: {e}")
                 pbar.update(1)
 
     print("Cut events complete.")
@@ -277,29 +450,34 @@ def cut_events_per_station(
     evtf: str,
     time_window: int,
     dest_dir: str,
+    fix_khole: bool = True,
 ) -> None:
     lst = Path(f"data_z.lst_{id}")
     db = Path(f"data_z.db_{id}")
     done_lst = Path(f"done_z.lst_{id}")
 
-    with lst.open("w") as f:
-        for sac in sta_path.rglob("*.sac"):
-            f.write(str(sac) + "\n")
-            st = obspy.read(sac)
-            stats = st[0].stats
-            if not stats.location:
-                stats.location = "10"
-                st.write(str(sac), format="SAC")
-
-    cmd_str = "echo shell start\n"
-    cmd_str += f"{mktraceiodb} -L {done_lst} -O {db} -LIST {lst} -V\n"
-    cmd_str += f"{cutevent} -V -ctlg {evtf} -tbl {db} -b +0 -e +{time_window} -out {dest_dir}\n"
-    cmd_str += "echo shell end\n"
-    subprocess.Popen(["bash"], stdin=subprocess.PIPE).communicate(cmd_str.encode())
-
-    lst.unlink()
-    db.unlink()
-    done_lst.unlink()
+    sacs = list(pather.scan_files(sta_path, "*.sac"))
+    lst.write_text("".join(f"{sac}\n" for sac in sacs))
+
+    if fix_khole:
+        for sac in sacs:
+            # only the 632-byte header is read, and rewritten in place if needed
+            header = SACTrace.read(sac, headonly=True)
+            if not header.khole:
+                header.khole = "10"
+                header.write(sac, headonly=True)
+
+    try:
+        subprocess.run(
+            [mktraceiodb, "-L", done_lst, "-O", db, "-LIST", lst, "-V"], check=True
+        )
+        cut_cmd = [cutevent, "-V", "-ctlg", evtf, "-tbl", db]
+        cut_cmd += ["-b", "+0", "-e", f"+{time_window}", "-out", dest_dir]
+        subprocess.run(cut_cmd, check=True)
+    finally:
+        lst.unlink(missing_ok=True)
+        db.unlink(missing_ok=True)
+        done_lst.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
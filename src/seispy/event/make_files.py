@@ -1,5 +1,6 @@
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
@@ -34,7 +35,7 @@ def filter_events(
         evt_df = pd.concat(
             [pd.read_csv(ievtf, usecols=required_columns) for ievtf in evtfs],
             ignore_index=True,
-        ).drop_duplicates(keep="first")
+        )
 
     else:
         raise ValueError("No event file provided.")
@@ -42,15 +43,22 @@ def filter_events(
     if evt_df.empty:
         raise ValueError("No events found.")
 
-    # 统一解析为 UTC datetime
+    # 统一解析为 UTC datetime, 按 ISO8601 解析, 不逐个推断格式
     evt_df["time"] = pd.to_datetime(
         evt_df["time"],
         utc=True,
         errors="coerce",
+        format="ISO8601",
+        cache=True,
     )
 
     evt_df = evt_df.dropna(subset=["time"]).copy()
 
+    if evtf is None:
+        # 多个文件中重复的事件只保留一个
+        # 时间解析后再去重: 按 int64 时间戳哈希, 而不是逐个比较字符串
+        evt_df = evt_df.drop_duplicates(keep="first")
+
     if evt_df.empty:
         raise ValueError("No valid events found after parsing time column.")
 
@@ -58,14 +66,14 @@ def filter_events(
     evt_df = evt_df.sort_values("time").reset_index(drop=True)
 
     if time_window and time_window > 0:
-        # 与前一个事件的时间差
-        dt_prev = evt_df["time"].diff().dt.total_seconds()
-
-        # 与后一个事件的时间差
-        dt_next = evt_df["time"].diff(-1).abs().dt.total_seconds()
+        # 相邻事件的时间差只算一次, 同时用于前一个和后一个事件
+        times = evt_df["time"].to_numpy(dtype="datetime64[ns]")
+        close = np.diff(times) / np.timedelta64(1, "s") < time_window
 
         # 只保留前后都不在 time_window 内的孤立事件
-        too_close = (dt_prev < time_window) | (dt_next < time_window)
+        too_close = np.zeros(len(times), dtype=bool)
+        too_close[1:] |= close
+        too_close[:-1] |= close
 
         filtered_df = evt_df.loc[~too_close].copy()
 
@@ -74,10 +82,10 @@ def filter_events(
 
     filtered_df = filtered_df.reset_index(drop=True)
 
-    # 保存前恢复为固定 UTC 字符串格式
-    filtered_df["time"] = (
-        filtered_df["time"].dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:23] + "Z"
-    )
+    # 保存前恢复为固定 UTC 字符串格式, 毫秒单独拼接, 不再逐个截断字符串
+    times = filtered_df["time"].dt
+    ms = (times.microsecond // 1000).astype(str).str.zfill(3)
+    filtered_df["time"] = times.strftime("%Y-%m-%dT%H:%M:%S.") + ms + "Z"
 
     if outfile is not None:
         filtered_df.to_csv(outfile, index=False, encoding="utf-8")
@@ -1,18 +1,23 @@
 import logging
-import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from fractions import Fraction
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
 
+import numpy as np
 import obspy
 from icecream import ic
-from rose import get_logger
+from rose import get_logger, pather
+from scipy.signal import resample_poly
 from tqdm import tqdm
 
 _LOG_RESAMPLE = {
     "name": "resample",
     "file": "resample.log",
     "level": logging.INFO,
+    "multiprocess": True,
 }
 
 
@@ -31,8 +36,9 @@ def resample_by_station(
     total = len(station_paths)
     logger.info(f"Found {total} stations.")
 
-    # resample
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    # resample, `sac` 方法只是等待子进程, 线程即可; obspy 计算密集用进程
+    pool = ThreadPoolExecutor if method.lower() == "sac" else ProcessPoolExecutor
+    with pool(max_workers=max_workers) as executor:
         futures = {
             executor.submit(
                 _resample_method(method), sta_path, pattern, delta, remove_src
@@ -55,7 +61,7 @@ def resample_by_station(
 def _resample_method(method):
     method = method.lower()
     if method == "obspy":
-        ic("NOTE: using Obspy `resample` not `decimate`.")
+        ic("NOTE: using polyphase `resample_poly` not `decimate`.")
         return obspy_resample_by_station
     if method == "sac":
         return sac_resample_by_station
@@ -68,24 +74,47 @@ def obspy_resample_by_station(
     logger = get_logger(**_LOG_RESAMPLE)
     total = 0
     failed = 0
-    for target in dir.rglob(pattern):
+    for target in map(Path, list(pather.scan_files(dir, pattern))):
         total += 1
         try:
-            st = obspy.read(target)
-            st.resample(delta)
+            st = obspy.read(target, check_compression=False)
+            for tr in st:
+                resample_trace(tr, delta)
             dest_sac = target.with_suffix(f".{delta}Hz.sac")
             st.write(str(dest_sac), format="SAC")
             if remove_src:
                 target.unlink()
-            logger.debug(f"resampled {target.name} -> {dest_sac.name}")
+            logger.debug("resampled %s -> %s", target.name, dest_sac.name)
         except Exception as e:
             failed += 1
             logger.error(f"Error occered at {target.parent} : {e}")
 
-    time.sleep(0.1)
     return total, failed
 
 
+def resample_trace(tr: obspy.Trace, sampling_rate: float) -> obspy.Trace:
+    """polyphase resample in place
+
+    Unlike the FFT based `Trace.resample`, the cost does not depend on how
+    npts factorizes (a prime npts makes the FFT orders of magnitude slower).
+    Works in float32, the SAC sample type, so a float64 trace is not carried
+    at twice the memory traffic only to be truncated when written.
+    """
+    up, down = (
+        Fraction(sampling_rate / tr.stats.sampling_rate)
+        .limit_denominator(1000)
+        .as_integer_ratio()
+    )
+    if up == down:
+        return tr
+    rate = tr.stats.sampling_rate * up / down
+    data = np.ascontiguousarray(tr.data, dtype=np.float32)
+    data = resample_poly(data, up, down, window=("kaiser", 5.0))
+    tr.data = data.astype(np.float32, copy=False)
+    tr.stats.sampling_rate = rate
+    return tr
+
+
 def resample_to(
     src_dir: str | Path,
     dest_dir: str | Path,
@@ -98,13 +127,13 @@ def resample_to(
     logger.info(f"Start resample from {src_dir} to {dest_dir} with {deltas=}.")
     src_path = Path(src_dir)
     dest_path = Path(dest_dir)
-    sac_paths = list(src_path.rglob(pattern))
+    sac_paths = list(map(Path, pather.scan_files(src_path, pattern)))
     batches = [sac_paths[i: i + bs] for i in range(0, len(sac_paths), bs)]
     total = len(sac_paths)
     logger.info(f"Found {total} stations.")
 
-    # resample
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    # resample, 工作都在 sac 子进程中, 线程只负责等待
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = {
             executor.submit(sac_resample_to, src_path, dest_path, bb, deltas)
             for bb in batches
@@ -118,47 +147,54 @@ def resample_to(
 def sac_resample_to(
     src_path: Path, dest_path: Path, sacs: List[Path], deltas: List[float]
 ):
-    import os
-    import subprocess
+    def commands():
+        for sac in sacs:
+            dest_sac = dest_path / sac.relative_to(src_path)
+            dest_sac.parent.mkdir(parents=True, exist_ok=True)
 
-    cmd = ""
-    for sac in sacs:
-        dest_sac = dest_path / sac.relative_to(src_path)
-        dest_sac.parent.mkdir(parents=True, exist_ok=True)
+            yield f"r {sac}\n"
+            for delta in deltas:
+                yield f"decimate {delta} \n"
+            yield f"w {dest_sac}\n"
 
-        cmd += f"r {sac}\n"
-        for delta in deltas:
-            cmd += f"decimate {delta} \n"
-        cmd += f"w {dest_sac}\n"
-    cmd += "q\n"
-
-    os.putenv("SAC_DISPLAY_COPYRIGHT", "0")
-    subprocess.Popen(["sac"], stdin=subprocess.PIPE).communicate(cmd.encode())
-
-    time.sleep(0.1)
+    run_sac(commands())
     return len(sacs)
 
 
 def sac_resample_by_station(
     dir: Path, pattern: str, delta: float, remove_src: bool
 ) -> Tuple[int, int]:
-    import os
-    import subprocess
-
     total = 0
-    cmd = ""
-    for target in dir.rglob(pattern):
-        cmd += f"r {target}\n"
-        cmd += f"decimate {delta} \n"
-        if remove_src:
-            cmd += "w over \n"
-        else:
-            cmd += f"w {target.with_suffix(f'.{delta}Hz.sac')}\n"
-        total += 1
-    cmd += "q\n"
 
-    os.putenv("SAC_DISPLAY_COPYRIGHT", "0")
-    subprocess.Popen(["sac"], stdin=subprocess.PIPE).communicate(cmd.encode())
+    def commands():
+        nonlocal total
+        for target in map(Path, list(pather.scan_files(dir, pattern))):
+            yield f"r {target}\n"
+            yield f"decimate {delta} \n"
+            if remove_src:
+                yield "w over \n"
+            else:
+                yield f"w {target.with_suffix(f'.{delta}Hz.sac')}\n"
+            total += 1
 
-    time.sleep(0.1)
+    run_sac(commands())
     return total, 0
+
+
+def run_sac(commands: Iterable[str]) -> None:
+    """stream SAC macro commands to one `sac` process
+
+    Commands are written as they are produced, so sac works on the first
+    files while the rest are still being listed, and the whole macro is
+    never held in memory.
+    """
+    os.putenv("SAC_DISPLAY_COPYRIGHT", "0")
+    proc = subprocess.Popen(["sac"], stdin=subprocess.PIPE)
+    try:
+        for command in commands:
+            proc.stdin.write(command.encode())
+        proc.stdin.write(b"q\n")
+        proc.stdin.close()
+    except BrokenPipeError:  # sac exited early
+        pass
+    proc.wait()
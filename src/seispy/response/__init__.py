@@ -1,8 +1,26 @@
-from seispy.response.remove_response import (
-    deconvolution_by_station,
-    stream_removed_response,
-)
-from seispy.response.response_file import combine, download, extract, filter
+import importlib
+
+# functions are imported on first access (PEP 562), so `import seispy.response`
+# does not load obspy's FDSN client and signal modules up front.
+_FUNCTIONS = {
+    "download": "seispy.response.response_file",
+    "combine": "seispy.response.response_file",
+    "filter": "seispy.response.response_file",
+    "extract": "seispy.response.response_file",
+    "deconvolution_by_station": "seispy.response.remove_response",
+    "stream_removed_response": "seispy.response.remove_response",
+}
+
+
+def __getattr__(name: str):
+    if name in _FUNCTIONS:
+        return getattr(importlib.import_module(_FUNCTIONS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
 
 __all__ = [
     "download",
@@ -1,18 +1,43 @@
 import logging
-import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import repeat
 from pathlib import Path
 from typing import Callable
 
+import numpy as np
 import obspy
-from rose import get_logger
+from obspy.signal.invsim import cosine_sac_taper
+from obspy.signal.util import _npts2nfft
+from rose import get_logger, pather
+from scipy.fft import irfft, rfft
+from scipy.signal.windows import hann
 from tqdm import tqdm
 
+from seispy.resample import resample_trace, run_sac
+
 _LOG_DECONVOLUTION = {
     "name": "deconvolution",
     "file": "deconvolution.log",
     "level": logging.INFO,
+    "multiprocess": True,
 }
+_PRE_FILT = (0.004, 0.006, 30, 35)
+# m -> nm, folded into the deconvolution kernel
+_SCALE = 1e9
+_TAPER_PERCENTAGE = 0.05
+_WRITE_THREADS = 2
+_BLOCK = 65536
+_MAX_PENDING_WRITES = 8
+# (seed id, nfft, delta) -> (response, kernel), least recently used first
+# a day long kernel is ~100 MB, keep only the channels in current use
+_KERNELS = OrderedDict()
+_KERNELS_LOCK = threading.Lock()
+_MAX_KERNELS = 8
+# inventory read once per worker process, see `_init_inventory`
+_INVENTORY = None
 
 
 def deconvolution_by_station(
@@ -46,29 +71,36 @@ def deconvolution_by_station(
     total = len(station_paths)
     logger.info(f"Found {total} stations.")
 
-    # read response if method is obspy
-    inv = obspy.read_inventory(resp) if method == "obspy" else resp
-
-    # remove response
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(
-                deconv_by_method(method),
-                sta_path,
-                pattern,
-                _get_response(method, inv, sta_path.name),
-                resample,
-                remove_src,
-            )
-            for sta_path in station_paths
-        }
+    # remove response, `sac` 方法只是等待子进程, 线程即可; obspy 计算密集用进程
+    # obspy 方法每个进程读取一次响应文件, 任务只传台站名, 不再 pickle Inventory
+    if method == "obspy":
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_inventory, initargs=(resp,)
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    deconv = partial(deconv_by_method(method), resample=resample, remove_src=remove_src)
+    responses = [_get_response(method, resp, p.name) for p in station_paths]
+    sizes = [1] * total
+    if method == "sac" and total:
+        # 每个线程一个 sac 会话处理一组台站, 不再每个台站启动一次 sac
+        # pole-zero 文件对所有台站相同
+        groups = min(max_workers, total)
+        station_paths = [station_paths[i::groups] for i in range(groups)]
+        responses = responses[:groups]
+        sizes = [len(paths) for paths in station_paths]
+    # several stations per task, amortizes the per-task IPC
+    chunksize = max(1, total // (max_workers * 4))
+    with executor:
+        results = executor.map(
+            deconv, station_paths, repeat(pattern), responses, chunksize=chunksize
+        )
         with tqdm(total=total, desc="Processing stations") as pbar:
             post = {"total": 0, "failed": 0}
-            for future in as_completed(futures):
-                batch_total, failed = future.result()
+            for size, (batch_total, failed) in zip(sizes, results):
                 post["total"] += batch_total
                 post["failed"] += failed
-                pbar.update(1)
+                pbar.update(size)
                 pbar.set_postfix(post)
 
     logger.info(f"Deconvolution complete with {post}.")
@@ -77,15 +109,25 @@ def deconvolution_by_station(
 
 def _get_response(method, resp, station):
     if method == "obspy":
-        inv = resp.select(station=station)
-        if len(inv):
-            return inv
-        raise ValueError(f"{station=} not found in the inventory.")
+        # selected from the worker's inventory, see `_station_inventory`
+        return station
     if method == "sac":
         return resp
     raise ValueError(f"Unknown method: {method}")
 
 
+def _init_inventory(resp):
+    global _INVENTORY
+    _INVENTORY = obspy.read_inventory(resp)
+
+
+def _station_inventory(station):
+    inv = _INVENTORY.select(station=station)
+    if len(inv):
+        return inv
+    raise ValueError(f"{station=} not found in the inventory.")
+
+
 def deconv_by_method(method) -> Callable:
     if method == "obspy":
         return obspy_deconv
@@ -94,53 +136,78 @@ def deconv_by_method(method) -> Callable:
     raise ValueError(f"Unknown method: {method}")
 
 
-def obspy_deconv(dir: Path, pattern, inv, resample, remove_src: bool):
+def obspy_deconv(dir: Path, pattern, station: str, resample, remove_src: bool):
     logger = get_logger(**_LOG_DECONVOLUTION)
+    inv = _station_inventory(station)
     total = 0
     failed = 0
-    for target in dir.rglob(pattern):
-        total += 1
+
+    def finish(target, future) -> bool:
         try:
-            st = stream_removed_response(target, inv, resample)
-            dest_sac = target.with_suffix(".deconv.sac")
-            st.write(str(dest_sac), format="SAC")
-            logger.debug(f"Deconvolution {target.name} -> {dest_sac.name}")
-            if remove_src:
-                target.unlink()
+            future.result()
+            return True
         except Exception as e:
-            failed += 1
             logger.error(f"Error occered at {target} : {e}")
+            return False
+
+    # 写文件交给I/O线程, 本进程接着处理下一个文件; 源文件在写完后才删除
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=_WRITE_THREADS) as io_pool:
+        for target in map(Path, list(pather.scan_files(dir, pattern))):
+            total += 1
+            try:
+                st = stream_removed_response(target, inv, resample)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error occered at {target} : {e}")
+                continue
+            future = io_pool.submit(_write_deconv, st, target, remove_src)
+            pending.append((target, future))
+            if len(pending) >= _MAX_PENDING_WRITES:
+                failed += not finish(*pending.popleft())
+        while pending:
+            failed += not finish(*pending.popleft())
 
-    time.sleep(0.1)
     return total, failed
 
 
-def sac_deconv(dir: Path, pattern, pzs, resample, remove_src):
-    import os
-    import subprocess
+def _write_deconv(st, target: Path, remove_src: bool):
+    dest_sac = target.with_suffix(".deconv.sac")
+    # deconvolved in double precision, stored as SAC's float32 samples
+    for tr in st:
+        tr.data = tr.data.astype(np.float32, copy=False)
+    st.write(str(dest_sac), format="SAC")
+    get_logger(**_LOG_DECONVOLUTION).debug(
+        "Deconvolution %s -> %s", target.name, dest_sac.name
+    )
+    if remove_src:
+        target.unlink()
+
 
+def sac_deconv(dir: Path | list[Path], pattern, pzs, resample, remove_src):
+    """deconvolution of one or several station dirs in a single sac session"""
     logger = get_logger(**_LOG_DECONVOLUTION)
     if resample is not None:
         logger.warning("resample is not supported by `sac` method")
 
+    dirs = [dir] if isinstance(dir, Path) else dir
     total = 0
-    cmd = ""
-    for target in dir.rglob(pattern):
-        total += 1
-        cmd += f"r {target}\n"
-        cmd += "rmean; rtr; taper \n"
-        cmd += f"trans from pol s {pzs} to none freq 0.004 0.006 30 35\n"
-        cmd += "mul 1.0e9 \n"
-        if remove_src:
-            cmd += "w over \n"
-        else:
-            cmd += f"w {target.with_suffix('.deconv.sac')}\n"
-    cmd += "q\n"
-
-    os.putenv("SAC_DISPLAY_COPYRIGHT", "0")
-    subprocess.Popen(["sac"], stdin=subprocess.PIPE).communicate(cmd.encode())
-
-    time.sleep(0.1)
+
+    def commands():
+        nonlocal total
+        targets = [target for d in dirs for target in pather.scan_files(d, pattern)]
+        for target in map(Path, targets):
+            total += 1
+            yield f"r {target}\n"
+            yield "rmean; rtr; taper \n"
+            yield f"trans from pol s {pzs} to none freq 0.004 0.006 30 35\n"
+            yield "mul 1.0e9 \n"
+            if remove_src:
+                yield "w over \n"
+            else:
+                yield f"w {target.with_suffix('.deconv.sac')}\n"
+
+    run_sac(commands())
     return total, 0
 
 
@@ -154,21 +221,106 @@ def stream_removed_response(file: str | Path, inv, resample=None):
     Returns:
         Stream: stream of deconvolution
     """
-    st = obspy.read(file)
-    st.merge(method=1, fill_value="interpolate")
-    for tr in st:
-        tr.detrend("demean")
-        tr.detrend("linear")
-        tr.taper(max_percentage=0.05, type="hann")
-        tr.remove_response(
-            inventory=inv,
-            water_level=None,
-            pre_filt=[0.004, 0.006, 30, 35],
-            output="DISP",
-            zero_mean=False,
-            taper=False,
-        )
-        tr.data *= 1e9
-        if resample is not None:
-            tr.resample(resample)
+    # SAC input as documented, skip probing every format plugin and archive type
+    st = obspy.read(file, format="SAC", check_compression=False)
+    # a SAC file holds one trace, only merge when there is something to merge
+    if len(st) > 1:
+        st.merge(method=1, fill_value="interpolate")
+    process = partial(_trace_removed_response, inv=inv, resample=resample)
+    if len(st) > 1:
+        # traces are independent and numpy releases the GIL in the FFTs
+        with ThreadPoolExecutor(max_workers=len(st)) as executor:
+            list(executor.map(process, st))
+    else:
+        for tr in st:
+            process(tr)
     return st
+
+
+def _trace_removed_response(tr, inv, resample=None):
+    tr.data = _detrend_taper(tr.data)
+    _remove_response(tr, inv)
+    if resample is not None:
+        resample_trace(tr, resample)
+
+
+def _detrend_taper(data):
+    """`detrend("demean")`, `detrend("linear")` and a 5% hann `taper` in
+    place on a float64 copy.
+
+    The linear fit also removes the mean, so one least squares fit replaces
+    both detrends, and only the tapered ends are multiplied."""
+    x = np.array(data, dtype=np.float64)
+    npts = len(x)
+    if npts > 1:
+        # closed form least squares line over the centered t = 0..npts-1
+        t = _centered_time(npts)
+        slope = (x @ t) / (npts * (npts**2 - 1) / 12)
+        x -= x.mean()
+        # block wise, the slope * t temporary stays small and cache resident
+        for i in range(0, npts, _BLOCK):
+            x[i : i + _BLOCK] -= slope * t[i : i + _BLOCK]
+    else:
+        x -= x.mean()
+
+    wlen, head, tail = _taper_sides(npts)
+    if wlen:
+        x[:wlen] *= head
+        x[npts - wlen :] *= tail
+    return x
+
+
+@lru_cache(maxsize=2)
+def _centered_time(npts):
+    """read only t - mean(t) for t = 0..npts-1, shared by same length traces"""
+    t = np.arange(npts, dtype=np.float64)
+    t -= (npts - 1) / 2
+    t.setflags(write=False)
+    return t
+
+
+@lru_cache(maxsize=16)
+def _taper_sides(npts):
+    """hann taper ends as built by `Trace.taper`"""
+    wlen = int(_TAPER_PERCENTAGE * npts)
+    sides = hann(2 * wlen if 2 * wlen == npts else 2 * wlen + 1)
+    return wlen, sides[:wlen], sides[len(sides) - wlen :]
+
+
+def _remove_response(tr, inv):
+    """`Trace.remove_response` to DISP with `_PRE_FILT`, no water level,
+    no zero mean and no taper, reusing the frequency domain kernel of traces
+    with the same id and length. The result is scaled by `_SCALE` (nm)."""
+    response = inv.get_response(tr.id, tr.stats.starttime)
+    data = np.asarray(tr.data, dtype=np.float64)
+    npts = len(data)
+    nfft = _npts2nfft(npts)
+    # scipy's pocketfft is SIMD vectorized, the spectrum is reused in place
+    spec = rfft(data, n=nfft)
+    spec *= _deconv_kernel(response, tr.id, nfft, tr.stats.delta)
+    spec[-1] = abs(spec[-1]) + 0.0j
+    tr.data = irfft(spec, n=nfft, overwrite_x=True)[:npts]
+
+
+def _deconv_kernel(response, seed_id, nfft, delta):
+    """pre_filt taper divided by the instrument response on the rfft grid"""
+    key = (seed_id, nfft, delta)
+    with _KERNELS_LOCK:
+        cached = _KERNELS.get(key)
+        # the response is kept in the cache, so `is` can not match a recycled id
+        if cached is not None and cached[0] is response:
+            _KERNELS.move_to_end(key)
+            return cached[1]
+
+    freq_response, freqs = response.get_evalresp_response(delta, nfft, output="DISP")
+    kernel = cosine_sac_taper(freqs, flimit=_PRE_FILT).astype(np.complex128)
+    # invert directly, the zero frequency response is zero and stays zero
+    kernel[0] = 0.0
+    kernel[1:] /= freq_response[1:]
+    kernel *= _SCALE
+    with _KERNELS_LOCK:
+        _KERNELS[key] = (response, kernel)
+        _KERNELS.move_to_end(key)
+        while len(_KERNELS) > _MAX_KERNELS:
+            _KERNELS.popitem(last=False)
+    return kernel
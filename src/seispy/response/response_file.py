@@ -2,9 +2,11 @@
 instrument responses from GEONET
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import obspy
+from lxml import etree
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 
@@ -41,10 +43,11 @@ def combine(responses: list[str | Path], outfile=None, starttime=None):
     Returns:
         _type_: stream
     """
+    # lxml 解析文件时释放 GIL, 多个文件并行读取, 按顺序合并
     combined_inv = obspy.Inventory()
-    for resp in responses:
-        inv = obspy.read_inventory(resp)
-        combined_inv += inv
+    with ThreadPoolExecutor(max_workers=min(8, len(responses) or 1)) as executor:
+        for inv in executor.map(obspy.read_inventory, responses):
+            combined_inv += inv
     if not len(combined_inv):
         raise ValueError("no response found")
 
@@ -57,7 +60,13 @@ def combine(responses: list[str | Path], outfile=None, starttime=None):
     return combined_inv
 
 
-def filter(resp, station_list: list[str], channel_list=[], outfile=None):
+def filter(
+    resp,
+    station_list: list[str],
+    channel_list: list[str] | None = None,
+    outfile=None,
+    fast_xml=False,
+):
     """
     从 resp 文件中过滤特定台站和通道。
 
@@ -65,9 +74,20 @@ def filter(resp, station_list: list[str], channel_list=[], outfile=None):
     :param station_list: 需要保留的台站列表 (e.g. ["WEL", "KHZ"])
     :param channel_list: 需要保留的通道列表 (e.g. ["HHZ", "HHE"])
     :param outfile: 过滤后的 XML 输出路径
+    :param fast_xml: 仅适用于 StationXML, 直接在 XML 树上过滤并写出 outfile,
+        不构建 ObsPy Inventory, 返回 None
     """
     from obspy.core.inventory import Inventory
 
+    # 集合查找, 不随列表长度线性增长
+    station_list = frozenset(station_list)
+    channel_list = frozenset(channel_list) if channel_list else None
+    if fast_xml:
+        if not outfile:
+            raise ValueError("fast_xml needs an outfile")
+        _filter_xml(resp, station_list, channel_list, outfile)
+        return None
+
     # 读取原始 resp
     inv = obspy.read_inventory(resp)
 
@@ -100,7 +120,30 @@ def filter(resp, station_list: list[str], channel_list=[], outfile=None):
     return new_inv
 
 
+def _filter_xml(resp, station_list, channel_list, outfile):
+    """`filter` 的 StationXML 版本, lxml 解析, 结果同 ObsPy 路径"""
+    tree = etree.parse(str(resp))
+    root = tree.getroot()
+    for net in list(root.iterfind("{*}Network")):
+        for sta in list(net.iterfind("{*}Station")):
+            if sta.get("code") not in station_list:
+                net.remove(sta)
+                continue
+            if channel_list:
+                for cha in list(sta.iterfind("{*}Channel")):
+                    if cha.get("code") not in channel_list:
+                        sta.remove(cha)
+            # 只保留有有效通道的台站
+            if sta.find("{*}Channel") is None:
+                net.remove(sta)
+        # 只保留有有效台站的网络
+        if net.find("{*}Station") is None:
+            root.remove(net)
+    tree.write(str(outfile), xml_declaration=True, encoding="UTF-8")
+
+
 def extract(resp_all, sta_list: list[str], outfile=None):
+    sta_list = frozenset(sta_list)
     inv = obspy.read_inventory(resp_all)
     # simple_inv = obspy.core.inventory.inventory.Inventory(
     simple_inv = obspy.Inventory(networks=[], source=inv.source)
@@ -131,8 +174,10 @@ def extract(resp_all, sta_list: list[str], outfile=None):
 
 
 def _shift_starttime(inv, starttime):
-    for net in inv:
-        for sta in net:
-            for cha in sta:
-                cha.start_date = obspy.UTCDateTime(*starttime)
+    # UTCDateTime is treated as immutable, all channels share one instance
+    start = obspy.UTCDateTime(*starttime)
+    for net in inv.networks:
+        for sta in net.stations:
+            for cha in sta.channels:
+                cha.start_date = start
     return inv